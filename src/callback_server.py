@@ -0,0 +1,174 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import time
+
+import msgspec
+from aiohttp import ClientSession, web
+from loguru import logger
+from vkbottle import API
+from vkbottle.bot import Bot
+from vkbottle.http import SingleAiohttpClient
+
+from config import (
+    CALLBACK_QUEUE_SIZE,
+    CALLBACK_SERVER_HOST,
+    CALLBACK_SERVER_PATH,
+    CALLBACK_SERVER_PORT,
+    CALLBACK_WORKERS,
+    PIPELINES_BY_GROUP
+)
+
+
+class CallbackServer:
+    """
+    Gets events from VK through Callback API. VK is answered right away,
+    events are handled by a fixed number of workers.
+    """
+    def __init__(
+        self,
+        bot: Bot,
+        apis_by_group: dict[int, API],
+        workers: int = CALLBACK_WORKERS,
+        queue_size: int = CALLBACK_QUEUE_SIZE,
+    ):
+        self.bot = bot
+        self.apis_by_group = apis_by_group
+        self.workers = workers
+        self.queue: asyncio.Queue[tuple[dict, API]] = asyncio.Queue(queue_size)
+        self.decoder = msgspec.json.Decoder()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        try:
+            event = self.decoder.decode(await request.read())
+        except msgspec.DecodeError:
+            return web.Response(status=400)
+        if not isinstance(event, dict):
+            return web.Response(status=400)
+
+        pipeline = PIPELINES_BY_GROUP.get(event.get('group_id'))
+        if pipeline is None:
+            logger.warning(f'Got an event from unknown group {event.get("group_id")}')
+            return web.Response(status=403)
+        # Secret is required, without it anyone could send events on behalf of admins
+        if not pipeline.callback_secret or event.get('secret') != pipeline.callback_secret:
+            logger.warning(f'Got an event with wrong secret for {pipeline.name}')
+            return web.Response(status=403)
+
+        if event.get('type') == 'confirmation':
+            logger.info(f'Confirming Callback API server of {pipeline.name}')
+            return web.Response(text=pipeline.callback_confirmation)
+
+        try:
+            self.queue.put_nowait((event, self.apis_by_group[pipeline.group_id]))
+        except asyncio.QueueFull:
+            # VK sends the event again later if it doesn't get "ok"
+            logger.warning('Callback API queue is full, asking VK to retry')
+            return web.Response(status=503)
+        return web.Response(text='ok')
+
+    async def worker(self) -> None:
+        while True:
+            event, api = await self.queue.get()
+            try:
+                # Same router that long polling uses
+                await self.bot.router.route(event, api)
+            except Exception as e:
+                logger.exception(f'Failed to handle Callback API event: {e}')
+            finally:
+                self.queue.task_done()
+
+    async def run(self, host: str, port: int, path: str = CALLBACK_SERVER_PATH) -> None:
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f'Callback API server is listening on http://{host}:{port}{path}')
+
+        try:
+            await asyncio.gather(*(self.worker() for _ in range(self.workers)))
+        finally:
+            await runner.cleanup()
+
+
+def run_callback_server(
+    bot: Bot,
+    apis_by_group: dict[int, API],
+    host: str = CALLBACK_SERVER_HOST,
+    port: int = CALLBACK_SERVER_PORT,
+) -> None:
+    # Callback API counterpart of run_multibot
+    for pipeline in PIPELINES_BY_GROUP.values():
+        if not pipeline.callback_secret or not pipeline.callback_confirmation:
+            raise SystemExit(
+                f'Pipeline {pipeline.name} needs both confirmation code and secret key'
+                ' for Callback API, set them in .env'
+            )
+    for api in apis_by_group.values():
+        api.http_client = SingleAiohttpClient()
+    server = CallbackServer(bot, apis_by_group)
+    bot.loop_wrapper.add_task(server.run(host, port))
+    bot.loop_wrapper.run()
+
+
+async def post_events(path: str, url: str, speed: float = 1) -> None:
+    """
+    Sends events from a cassette to a running server, just like VK would.
+    Secret of the pipeline is added to every event.
+    """
+    from cassette import load_cassette
+
+    encoder = msgspec.json.Encoder()
+    events = [entry for entry in load_cassette(path) if entry['kind'] == 'event']
+    started = time.monotonic()
+    async with ClientSession() as session:
+        for entry in events:
+            delay = entry['t'] / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            event = entry['data']
+            pipeline = PIPELINES_BY_GROUP.get(event.get('group_id'))
+            if pipeline:
+                event['secret'] = pipeline.callback_secret
+            sent = time.monotonic()
+            async with session.post(url, data=encoder.encode(event)) as response:
+                answer = await response.text()
+            logger.info(
+                f'{event.get("type")}: {response.status} {answer!r}'
+                f' in {(time.monotonic() - sent) * 1000:.1f}ms'
+            )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description='Posts events from a recorded cassette to a Callback API server'
+    )
+    parser.add_argument('path')
+    parser.add_argument(
+        '--url', default=f'http://127.0.0.1:{CALLBACK_SERVER_PORT}{CALLBACK_SERVER_PATH}'
+    )
+    parser.add_argument('--speed', type=float, default=1, help='1 is real speed, 10 is 10x')
+    args = parser.parse_args()
+    await post_events(args.path, args.url, args.speed)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,335 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import base64
+import contextvars
+import copy
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Awaitable, Callable
+
+import msgspec
+from loguru import logger
+
+import config
+
+# Cassette is a JSON lines file, every line is one of these:
+# {"t": seconds since recording started, "kind": ..., "key": ..., "data": ..., "duration": ...}
+# Kinds:
+#   event     - update from VK, key is the group id
+#   vk        - VK API reply, key is the method
+#   danbooru  - DanbooruSearcher.search response, key is the query
+#   image     - downloaded image, key is the url
+#   upload    - attachment returned by an uploader, key is uploader's name
+
+
+class CassetteRecorder:
+    def __init__(self, path: str):
+        self.file = open(path, 'ab')
+        self.encoder = msgspec.json.Encoder()
+        self.start = time.monotonic()
+
+    def write(self, kind: str, key: Any, data: Any, duration: float = 0) -> None:
+        entry = {
+            't': time.monotonic() - self.start,
+            'kind': kind,
+            'key': key,
+            'data': data,
+            'duration': duration,
+        }
+        self.file.write(self.encoder.encode(entry) + b'\n')
+        self.file.flush()
+
+    def wrap(
+        self,
+        kind: str,
+        func: Callable[..., Awaitable[Any]],
+        get_key: Callable[..., Any],
+    ) -> Callable[..., Awaitable[Any]]:
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                self.write(kind, get_key(*args, **kwargs), {'error': repr(e)})
+                raise
+            self.write(kind, get_key(*args, **kwargs), result, time.monotonic() - started)
+            return result
+        return wrapper
+
+
+def record_cassette(path: str, bot, apis: list, searcher, uploaders: dict) -> None:
+    """
+    Starts writing everything the bot receives from the outside world into a cassette.
+    `uploaders` maps names to uploaders, replay looks them up by the same names.
+    """
+    import utils
+
+    recorder = CassetteRecorder(path)
+    logger.info(f'Recording cassette to {path}')
+
+    # Router instance is persistent, bot.router only configures it
+    router = bot.router
+    route = router.route
+
+    async def recording_route(event: dict, ctx_api):
+        recorder.write('event', event.get('group_id'), event)
+        return await route(event, ctx_api)
+    router.route = recording_route
+
+    for api in apis:
+        api.request = recorder.wrap('vk', api.request, lambda method, *_, **__: method)
+    searcher.search = recorder.wrap(
+        'danbooru', searcher.search, lambda query, *_, **__: query
+    )
+    utils.img_url_to_bytes = recorder.wrap(
+        'image', utils.img_url_to_bytes, lambda url, *_, **__: url
+    )
+    for name, uploader in uploaders.items():
+        uploader.upload = recorder.wrap(
+            'upload', uploader.upload, lambda *_, name=name, **__: name
+        )
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplaySession:
+    """
+    One replay of a cassette. Every session has its own copy of recorded replies,
+    so many sessions can run at once against the same stand-ins.
+    Sessions run in one bot, so they share its caches and db, like admins of one group do:
+    a post is only downloaded and uploaded once, other sessions get it from the caches.
+    """
+    def __init__(self, index: int, entries: list[dict], speed: float):
+        self.index = index
+        self.speed = speed
+        self.events = [entry for entry in entries if entry['kind'] == 'event']
+        self.replies: dict[tuple[str, Any], deque] = defaultdict(deque)
+        for entry in entries:
+            if entry['kind'] != 'event':
+                self.replies[(entry['kind'], entry['key'])].append(entry)
+        self.recorded_counts = Counter(
+            entry['kind'] for entry in entries if entry['kind'] != 'event'
+        )
+        self.used_counts: Counter[str] = Counter()
+
+        # Searches get new ids in the replay db, they're matched by order of appearance
+        self.recorded_search_ids = []
+        for event in self.events:
+            search_id = _get_payload(event['data']).get('search_id')
+            if search_id is not None and search_id not in self.recorded_search_ids:
+                self.recorded_search_ids.append(search_id)
+        self.replayed_search_ids = []
+        self.search_id_found = asyncio.Event()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+
+    async def take(self, kind: str, key: Any) -> Any:
+        replies = self.replies.get((kind, key))
+        if not replies:
+            raise ReplayError(f'Nothing was recorded for {kind} {key!r}')
+        # Last reply is reused if the handlers ask for more than was recorded
+        entry = replies.popleft() if len(replies) > 1 else replies[0]
+        self.used_counts[kind] += 1
+        await asyncio.sleep(entry['duration'] / self.speed)
+        if isinstance(entry['data'], dict) and 'error' in entry['data']:
+            raise ReplayError(entry['data']['error'])
+        return copy.deepcopy(entry['data'])
+
+    def notice_search_ids(self, params: dict) -> None:
+        # Replayed search ids are taken from keyboards that the bot sends
+        keyboard = params.get('keyboard')
+        if not keyboard:
+            return
+        for row in msgspec.json.decode(keyboard)['buttons']:
+            for button in row:
+                payload = button['action'].get('payload') or {}
+                if isinstance(payload, str):
+                    payload = msgspec.json.decode(payload)
+                search_id = payload.get('search_id')
+                if search_id is not None and search_id not in self.replayed_search_ids:
+                    self.replayed_search_ids.append(search_id)
+                    self.search_id_found.set()
+
+    def is_cold(self) -> bool:
+        # Cold sessions did all the downloads and uploads themselves, warm ones used caches
+        return all(
+            self.used_counts[kind] >= self.recorded_counts[kind] for kind in ('image', 'upload')
+        )
+
+    async def map_search_id(self, recorded_search_id: int) -> int:
+        index = self.recorded_search_ids.index(recorded_search_id)
+        while len(self.replayed_search_ids) <= index:
+            self.search_id_found.clear()
+            await asyncio.wait_for(self.search_id_found.wait(), timeout=30)
+        return self.replayed_search_ids[index]
+
+
+_current_session: contextvars.ContextVar[ReplaySession] = contextvars.ContextVar('session')
+
+
+def _get_payload(event: dict) -> dict:
+    payload = (event.get('object') or {}).get('payload')
+    return payload if isinstance(payload, dict) else {}
+
+
+def load_cassette(path: str) -> list[dict]:
+    decoder = msgspec.json.Decoder()
+    with open(path, 'rb') as f:
+        return [decoder.decode(line) for line in f if line.strip()]
+
+
+def install_stand_ins(apis: list, searcher, uploaders: dict) -> None:
+    # Same objects as in record_cassette, but replies now come from the current session
+    import utils
+
+    async def request(method: str, data: dict, *args, **kwargs):
+        session = _current_session.get()
+        session.notice_search_ids(data)
+        return await session.take('vk', method)
+
+    async def search(query: str, *args, **kwargs):
+        return await _current_session.get().take('danbooru', query)
+
+    async def img_url_to_bytes(url: str, *args, **kwargs) -> bytes:
+        return base64.b64decode(await _current_session.get().take('image', url))
+
+    for api in apis:
+        api.request = request
+    searcher.search = search
+    utils.img_url_to_bytes = img_url_to_bytes
+    for name, uploader in uploaders.items():
+        async def upload(*args, name=name, **kwargs):
+            return await _current_session.get().take('upload', name)
+        uploader.upload = upload
+
+
+async def run_replay_session(session: ReplaySession, bot, apis_by_group: dict) -> None:
+    _current_session.set(session)
+    router = bot.router
+    started = time.monotonic()
+
+    async def replay_event(event: dict) -> None:
+        update = copy.deepcopy(event['data'])
+        payload = _get_payload(update)
+        if 'search_id' in payload:
+            payload['search_id'] = await session.map_search_id(payload['search_id'])
+
+        name = update.get('type', 'unknown')
+        if 'cmd' in payload:
+            name += f':{payload["cmd"]}'
+        api = apis_by_group.get(update.get('group_id'), next(iter(apis_by_group.values())))
+        handle_started = time.monotonic()
+        await router.route(update, api)
+        session.latencies[name].append(time.monotonic() - handle_started)
+
+    tasks = []
+    for event in session.events:
+        delay = event['t'] / session.speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Just like in polling, every event is handled in its own task
+        tasks.append(asyncio.create_task(replay_event(event)))
+
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f'Session {session.index} failed to replay an event: {result!r}')
+
+
+def report_sessions(sessions: list[ReplaySession]) -> None:
+    # Warm sessions are faster only because of the other sessions, so they're reported apart
+    for label, group in (
+        ('cold', [session for session in sessions if session.is_cold()]),
+        ('warm', [session for session in sessions if not session.is_cold()]),
+    ):
+        if not group:
+            continue
+        used = ', '.join(
+            f'{kind} {sum(session.used_counts[kind] for session in group)}'
+            f'/{sum(session.recorded_counts[kind] for session in group)}'
+            for kind in ('danbooru', 'image', 'upload')
+        )
+        logger.info(f'{len(group)} {label} sessions, recorded replies used: {used}')
+        report_latencies(group)
+
+
+def report_latencies(sessions: list[ReplaySession]) -> None:
+    latencies: dict[str, list[float]] = defaultdict(list)
+    for session in sessions:
+        for name, values in session.latencies.items():
+            latencies[name].extend(values)
+
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        logger.info(
+            f'{name}: {len(values)} events, median {statistics.median(values) * 1000:.1f}ms,'
+            f' p95 {p95 * 1000:.1f}ms, max {values[-1] * 1000:.1f}ms'
+        )
+
+
+async def replay(path: str, speed: float = 1, sessions_count: int = 1) -> None:
+    entries = load_cassette(path)
+
+    # Replays never touch the real db, db.py reads DB_PATH when it's imported
+    db_dir = tempfile.mkdtemp(prefix='hutao-replay-')
+    config.DB_PATH = f'{db_dir}/db.db'
+    import main
+    from db import create_db
+
+    await create_db()
+    apis = [*main.pipeline_apis.values(), main.user.api]
+    uploaders = {'wall': main.photo_wall_upl, **main.photo_msg_upls}
+    install_stand_ins(apis, main.dan, uploaders)
+    apis_by_group = {
+        pipeline.group_id: main.pipeline_apis[pipeline.name] for pipeline in config.PIPELINES
+    }
+
+    sessions = [ReplaySession(i, entries, speed) for i in range(sessions_count)]
+    logger.info(
+        f'Replaying {len(sessions[0].events)} events in {sessions_count} sessions'
+        f' at {speed}x speed, db is in {db_dir}'
+    )
+    started = time.monotonic()
+    await asyncio.gather(
+        *(run_replay_session(session, main.bot, apis_by_group) for session in sessions)
+    )
+    logger.info(f'Replay took {time.monotonic() - started:.2f}s')
+    report_sessions(sessions)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Replays a recorded cassette offline')
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=1, help='1 is real speed, 10 is 10x')
+    parser.add_argument(
+        '--sessions',
+        type=int,
+        default=1,
+        help='How many replays run at once, they share caches and db of one bot',
+    )
+    args = parser.parse_args()
+    await replay(args.path, args.speed, args.sessions)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -16,21 +16,124 @@
 # along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+from dataclasses import dataclass
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Group ID must be positive
-GROUP_ID = 193964161
-ADMIN_IDS = (322615766, 504114608,)
 
-# Set in seconds
-post_interval = 3600
+@dataclass(frozen=True)
+class PostFilter:
+    # Tags are Danbooru tags, like in tag_string. Whatever doesn't fit into
+    # the query is checked after the posts are downloaded, see post_filter.py
+    blocked_tags: tuple[str, ...] = ()
+    required_tags: tuple[str, ...] = ()
+    min_score: int | None = None
+    # Set in bytes
+    min_file_size: int | None = None
+    max_file_size: int | None = None
+
+
+@dataclass(frozen=True)
+class Pipeline:
+    # Name must be unique, it's used to keep every pipeline's data apart in the db
+    name: str
+    # Group ID must be positive
+    group_id: int
+    # Group token
+    token: str | None
+    admin_ids: tuple[int, ...]
+    query: str
+    # Used in bot messages and posts, e.g. "1 день без рерана Ху Тао"
+    character_name: str
+    # Hashtag that always goes first
+    character_tag: str
+    # Every pipeline needs its own file
+    last_rerun_date_path: str
+    # Russian variant of character_tag, goes right after it
+    russian_tag: str | None = None
+    # Character tags that shouldn't become hashtags
+    ignore_tags: tuple[str, ...] = ()
+    # Set in seconds
+    post_interval: int = 3600
+    rerun_day_search_re: str = r'(\d+) день без рерана'
+    post_filter: PostFilter = PostFilter()
+    # Only needed in Callback API mode, both are shown in group's Callback API settings
+    callback_confirmation: str | None = None
+    callback_secret: str | None = None
+
+
+PIPELINES = (
+    Pipeline(
+        name='hu_tao',
+        group_id=193964161,
+        token=os.getenv('VK_API_TOKEN'),
+        admin_ids=(322615766, 504114608,),
+        query='hu_tao_(genshin_impact) -rating:e',
+        character_name='Ху Тао',
+        character_tag='HuTao',
+        last_rerun_date_path='./last_rerun.txt',
+        russian_tag='ХуТао',
+        ignore_tags=(
+            'boo_tao_(genshin_impact)',
+            'hu_tao_(lawson)_(genshin_impact)',
+            'hu_tao_(oneplus)_(genshin_impact)',
+            'hu_tao_(galaxy_store)_(genshin_impact)',
+            'hu_tao_(cherries_snow-laden)_(genshin_impact)'
+        ),
+        post_filter=PostFilter(blocked_tags=('animated',)),
+        callback_confirmation=os.getenv('VK_CALLBACK_CONFIRMATION'),
+        callback_secret=os.getenv('VK_CALLBACK_SECRET'),
+    ),
+)
+PIPELINES_BY_GROUP = {pipeline.group_id: pipeline for pipeline in PIPELINES}
+assert len(PIPELINES_BY_GROUP) == len(PIPELINES), 'Every pipeline must have its own group'
+assert len({pipeline.name for pipeline in PIPELINES}) == len(PIPELINES), (
+    'Every pipeline must have its own name'
+)
+assert len({pipeline.last_rerun_date_path for pipeline in PIPELINES}) == len(PIPELINES), (
+    'Every pipeline must have its own last rerun date file'
+)
+
+# How many rating changes a review session keeps in memory before writing them to the db
+SESSION_FLUSH_BATCH_SIZE = 5
+# How many review sessions are kept in memory at once
+MAX_CACHED_SESSIONS = 16
+# For how long (in seconds) repeated presses of the same button are ignored
+CALLBACK_DEDUP_TTL = 5
+# For how long (in seconds) a post waits for its photo before it's shown without it
+PHOTO_LATENCY_BUDGET = 0.7
+# How many posts are shown on one page of review history
+HISTORY_PAGE_SIZE = 10
+# For how long (in seconds) the postponed queue read from VK is trusted
+PUBLISH_SCHEDULE_TTL = 3600
+# For how long (in seconds) startup waits for each warm-up step before giving up on it
+WARM_UP_TIMEOUT = 5
+# For how long (in seconds) VK API calls are collected into one execute request
+EXECUTE_BATCH_WINDOW = 0.05
+# For how long (in seconds) a call waits for its execute request before giving up
+EXECUTE_CALL_TIMEOUT = 30
+# These are shared by all pipelines, downloaded previews are cached up to this many bytes
+IMAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+ATTACHMENT_CACHE_SIZE = 256
+DANBOORU_MAX_CONCURRENT_REQUESTS = 2
+# Anonymous users can search for 2 tags at once, Gold users for 6
+DANBOORU_TAG_LIMIT = 2
+# How many new posts one search tries to find and how many result pages it may go through
+SEARCH_BATCH_SIZE = 10
+DANBOORU_PAGE_SIZE = 20
+DANBOORU_MAX_SEARCH_PAGES = 5
+# Danbooru returns at most 100 posts for one "id:1,2,3" search
+DANBOORU_IDS_PER_REQUEST = 100
+# Used by ".profile": how often (in seconds) stacks are sampled, for how long the loop
+# has to be stuck to count as blocked, how many frames and results the report shows
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_BLOCK_THRESHOLD = 0.1
+PROFILE_STACK_DEPTH = 8
+PROFILE_TOP = 10
+PROFILE_MAX_SECONDS = 300
 
-HU_TAO_QUERY = 'hu_tao_(genshin_impact) -animated -rating:e'
-RERUN_DAY_SEARCH_RE = r'(\d+) день без рерана'
-HU_TAO_RUSSIAN_TAG = 'ХуТао'
 CHARACTER_RENAMINGS = {
     'KamisatoAyaka': 'Ayaka',
     'KamisatoAyato': 'Ayato',
@@ -39,16 +142,18 @@ CHARACTER_RENAMINGS = {
     'SangonomiyaKokomi': 'Kokomi',
     'ShikanoinHeizou': 'Heizou',
 }
-IGNORE_TAGS = (
-    'boo_tao_(genshin_impact)',
-    'hu_tao_(lawson)_(genshin_impact)',
-    'hu_tao_(oneplus)_(genshin_impact)',
-    'hu_tao_(galaxy_store)_(genshin_impact)',
-    'hu_tao_(cherries_snow-laden)_(genshin_impact)'
-)
 
 DB_PATH = './db.db'
-LAST_RERUN_DATE_PATH = './last_rerun.txt'
 
-VK_API_TOKEN = os.getenv('VK_API_TOKEN')
 VK_USER_API_TOKEN = os.getenv('VK_USER_API_TOKEN')
+
+# If the port is set, VK sends events to a Callback API server instead of long polling
+CALLBACK_SERVER_HOST = os.getenv('CALLBACK_SERVER_HOST', '0.0.0.0')
+CALLBACK_SERVER_PORT = int(os.getenv('CALLBACK_SERVER_PORT') or 0)
+CALLBACK_SERVER_PATH = '/callback'
+# How many events are handled at once and how many can wait for that
+CALLBACK_WORKERS = 8
+CALLBACK_QUEUE_SIZE = 100
+
+# If set, everything the bot gets from VK and Danbooru is recorded there, see cassette.py
+CASSETTE_RECORD_PATH = os.getenv('CASSETTE_RECORD_PATH')
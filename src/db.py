@@ -16,144 +16,637 @@
 # along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
-from typing import Literal
+import os
+import re
+import sqlite3
+from contextlib import closing
+from typing import AsyncIterator, Literal
 
 import aiosqlite
+from loguru import logger
 
-from config import DB_PATH
+from config import DB_PATH, PIPELINES
 
+# Every table has a pipeline column, so that many pipelines can share one database
 SQL_POSTS_TABLE = """CREATE TABLE IF NOT EXISTS posts (
-    id INTEGER PRIMARY KEY UNIQUE,
+    id INTEGER NOT NULL,
     status TEXT DEFAULT "no_rating" NOT NULL,
-    preview_url TEXT NOT NULL,
-    file_url TEXT NOT NULL,
-    artist TEXT NOT NULL,
-    characters TEXT NOT NULL,
-    url TEXT NOT NULL,
-    source TEXT NOT NULL
+    -- Urls are rendered from these on read, see _render_urls
+    md5 TEXT,
+    file_ext TEXT,
+    has_large INTEGER DEFAULT 0 NOT NULL,
+    -- Only set for urls that can't be rendered, which is rare
+    file_url TEXT,
+    preview_url TEXT,
+    url TEXT,
+    artist_id INTEGER NOT NULL REFERENCES artists (artist_id),
+    source TEXT NOT NULL,
+    pipeline TEXT NOT NULL,
+    -- Unlike implicit rowid, this one never changes, so posts_fts can rely on it
+    uid INTEGER PRIMARY KEY,
+    UNIQUE (pipeline, id)
     -- Possible status values: 'no_rating', 'to_post', 'deleted'
 );"""
+SQL_ARTISTS_TABLE = """CREATE TABLE IF NOT EXISTS artists (
+    artist_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);"""
+# Characters are stored the way they're shown in posts, e.g. "#HuTao"
+SQL_CHARACTERS_TABLE = """CREATE TABLE IF NOT EXISTS characters (
+    character_id INTEGER PRIMARY KEY,
+    tag TEXT NOT NULL UNIQUE
+);"""
+SQL_POST_CHARACTERS_TABLE = """CREATE TABLE IF NOT EXISTS post_characters (
+    post_uid INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    character_id INTEGER NOT NULL REFERENCES characters (character_id),
+    PRIMARY KEY (post_uid, position)
+) WITHOUT ROWID;"""
 SQL_SEARCHES_TABLE = """CREATE TABLE IF NOT EXISTS searches (
     search_id INTEGER PRIMARY KEY UNIQUE,
-    search_posts TEXT NOT NULL
+    search_posts TEXT NOT NULL,
+    pipeline TEXT NOT NULL
 );"""
 SQL_VK_ATTACHMENTS_TABLE = """CREATE TABLE IF NOT EXISTS vk_attachments (
-    id INTEGER PRIMARY KEY UNIQUE,
-    attachment TEXT NOT NULL
+    id INTEGER NOT NULL,
+    attachment TEXT NOT NULL,
+    pipeline TEXT NOT NULL,
+    PRIMARY KEY (pipeline, id)
+);"""
+TABLES = (
+    ('posts', SQL_POSTS_TABLE),
+    ('artists', SQL_ARTISTS_TABLE),
+    ('characters', SQL_CHARACTERS_TABLE),
+    ('post_characters', SQL_POST_CHARACTERS_TABLE),
+    ('searches', SQL_SEARCHES_TABLE),
+    ('vk_attachments', SQL_VK_ATTACHMENTS_TABLE),
+)
+# Posts used to be stored with full urls and hashtags, these are compacted by create_db
+SQL_WIDE_POSTS_TABLE = """CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER NOT NULL,
+    status TEXT DEFAULT "no_rating" NOT NULL,
+    preview_url TEXT NOT NULL,
+    file_url TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    characters TEXT NOT NULL,
+    url TEXT NOT NULL,
+    source TEXT NOT NULL,
+    pipeline TEXT NOT NULL,
+    uid INTEGER PRIMARY KEY,
+    UNIQUE (pipeline, id)
+);"""
+
+# Full text search over artists and characters, its rowid is posts.uid.
+# It's contentless, so it only keeps the index and not another copy of the texts
+SQL_POSTS_FTS_TABLE = """CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    artist,
+    characters,
+    content=''
 );"""
+# Used by review history, it goes through posts from newest to oldest
+SQL_POSTS_STATUS_INDEX = """CREATE INDEX IF NOT EXISTS posts_status_idx
+    ON posts (pipeline, status, id);"""
+# Finds posts of one character without going through all of them
+SQL_POST_CHARACTERS_INDEX = """CREATE INDEX IF NOT EXISTS post_characters_character_idx
+    ON post_characters (character_id, post_uid);"""
+
+# Columns are read by _post_from_row. Characters are joined back in the order they were saved
+SQL_SELECT_POSTS = """SELECT
+    posts.id, posts.status, posts.md5, posts.file_ext, posts.has_large,
+    posts.file_url, posts.preview_url, posts.url, artists.name AS artist,
+    coalesce((
+        SELECT group_concat(tag, ' ') FROM (
+            SELECT characters.tag FROM post_characters
+            JOIN characters USING (character_id)
+            WHERE post_characters.post_uid = posts.uid
+            ORDER BY post_characters.position
+        )
+    ), '') AS characters,
+    posts.source, posts.pipeline, posts.uid
+FROM posts JOIN artists USING (artist_id)"""
+
+# Keys of the posts that are returned, pipeline is only added by iter_posts
+POST_KEYS = (
+    'id', 'status', 'preview_url', 'file_url', 'artist', 'characters', 'url', 'source',
+    'pipeline'
+)
+_FILE_URL_RE = re.compile(r'https://cdn\.donmai\.us/original/../../([0-9a-f]{32})\.(\w+)')
+# Older SQLite versions don't allow more than 999 variables in one query
+_MAX_VARIABLES = 500
+
+
+def _file_url(md5: str, file_ext: str) -> str:
+    return f'https://cdn.donmai.us/original/{md5[:2]}/{md5[2:4]}/{md5}.{file_ext}'
+
+
+def _sample_url(md5: str) -> str:
+    return f'https://cdn.donmai.us/sample/{md5[:2]}/{md5[2:4]}/sample-{md5}.jpg'
+
+
+def _post_url(post_id: int) -> str:
+    return f'https://danbooru.donmai.us/posts/{post_id}'
+
+
+def _compact_urls(post: dict) -> tuple:
+    """
+    Returns md5, file_ext and has_large of the post, plus file_url, preview_url and url
+    that can't be rendered back from them (None for the ones that can).
+    """
+    md5 = file_ext = None
+    file_url, preview_url, url = post['file_url'], post['preview_url'], post['url']
+    match = _FILE_URL_RE.fullmatch(file_url)
+    if match and _file_url(*match.groups()) == file_url:
+        md5, file_ext = match.groups()
+        file_url = None
+
+    has_large = 0
+    if md5 and preview_url == post['file_url']:
+        # Small images don't have a sample, Danbooru gives the original instead
+        preview_url = None
+    elif md5 and preview_url == _sample_url(md5):
+        has_large = 1
+        preview_url = None
+
+    if url == _post_url(post['id']):
+        url = None
+    return md5, file_ext, has_large, file_url, preview_url, url
+
+
+def _render_urls(
+    post_id: int,
+    md5: str | None,
+    file_ext: str | None,
+    has_large: int,
+    file_url: str | None,
+    preview_url: str | None,
+    url: str | None,
+) -> tuple[str, str, str]:
+    # Opposite of _compact_urls, returns file_url, preview_url and url
+    if md5:
+        file_url = file_url or _file_url(md5, file_ext)
+        preview_url = preview_url or (_sample_url(md5) if has_large else file_url)
+    return file_url, preview_url, url or _post_url(post_id)
+
+
+def _chunks(items: list, size: int = _MAX_VARIABLES):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+async def _get_columns(db: aiosqlite.Connection, table: str) -> list[str]:
+    cursor = await db.execute(f'PRAGMA table_info({table});')
+    return [row[1] for row in await cursor.fetchall()]
+
+
+async def _migrate_table(db: aiosqlite.Connection, table: str, create_sql: str) -> bool:
+    """
+    Rebuilds the table if its columns don't match the ones from `create_sql`.
+    New columns get their default values, except pipeline: before pipelines were added,
+    everything in the db belonged to the first one.
+    Returns True if the table was rebuilt.
+    """
+    old_columns = await _get_columns(db, table)
+    if not old_columns:
+        return False
+
+    await db.execute(create_sql.replace(f'EXISTS {table} (', f'EXISTS new_{table} (', 1))
+    new_columns = await _get_columns(db, f'new_{table}')
+    if set(old_columns) == set(new_columns):
+        await db.execute(f'DROP TABLE new_{table};')
+        return False
+
+    logger.info(f'Migrating "{table}" table to the new schema')
+    columns = [column for column in new_columns if column in old_columns]
+    values = columns.copy()
+    params = ()
+    if 'pipeline' not in old_columns:
+        columns.append('pipeline')
+        values.append('?')
+        params = (PIPELINES[0].name,)
+    await db.execute(
+        f'INSERT INTO new_{table} ({", ".join(columns)})'
+        f' SELECT {", ".join(values)} FROM {table};',
+        params
+    )
+    await db.execute(f'DROP TABLE {table};')
+    await db.execute(f'ALTER TABLE new_{table} RENAME TO {table};')
+    return True
+
+
+async def _compact_wide_posts(db: aiosqlite.Connection) -> None:
+    # Moves posts from the old wide table into the compact one, chunk by chunk
+    logger.info('Moving posts to the compact schema')
+    columns = (
+        'id', 'status', 'preview_url', 'file_url', 'artist', 'characters', 'url', 'source',
+        'pipeline', 'uid'
+    )
+    last_uid = 0
+    while True:
+        cursor = await db.execute(
+            f'SELECT {", ".join(columns)} FROM wide_posts WHERE uid > ? ORDER BY uid LIMIT ?;',
+            (last_uid, _MAX_VARIABLES)
+        )
+        rows = await cursor.fetchall()
+        if not rows:
+            break
+        await save_posts(db, [dict(zip(columns, row)) for row in rows])
+        last_uid = rows[-1][-1]
+    await db.execute('DROP TABLE wide_posts;')
+
+
+async def _rebuild_posts_fts(db: aiosqlite.Connection) -> None:
+    await db.execute("INSERT INTO posts_fts (posts_fts) VALUES ('delete-all');")
+    await db.execute(
+        'INSERT INTO posts_fts (rowid, artist, characters)'
+        f' SELECT uid, artist, characters FROM ({SQL_SELECT_POSTS});'
+    )
 
 
 async def create_db() -> None:
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(SQL_POSTS_TABLE)
-        await db.execute(SQL_SEARCHES_TABLE)
-        await db.execute(SQL_VK_ATTACHMENTS_TABLE)
+        wide_posts = 'characters' in await _get_columns(db, 'posts')
+        if wide_posts:
+            # Old posts are brought to the last wide schema first, then compacted
+            await _migrate_table(db, 'posts', SQL_WIDE_POSTS_TABLE)
+            await db.execute('ALTER TABLE posts RENAME TO wide_posts;')
+
+        posts_migrated = wide_posts
+        for table, create_sql in TABLES:
+            migrated = await _migrate_table(db, table, create_sql)
+            posts_migrated = posts_migrated or (migrated and table == 'posts')
+            await db.execute(create_sql)
+
+        cursor = await db.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'posts_fts';"
+        )
+        fts_row = await cursor.fetchone()
+        fts_outdated = fts_row is not None and "content=''" not in fts_row[0]
+        if fts_outdated:
+            # It used to keep a copy of the texts, it's built again without it
+            await db.execute('DROP TABLE posts_fts;')
+        await db.execute(SQL_POSTS_FTS_TABLE)
+        if wide_posts:
+            # Old indexes are dropped together with the old table
+            await _compact_wide_posts(db)
+        await db.execute(SQL_POSTS_STATUS_INDEX)
+        await db.execute(SQL_POST_CHARACTERS_INDEX)
+
+        if posts_migrated or fts_row is None or fts_outdated:
+            logger.info('Building full text search index for posts')
+            await _rebuild_posts_fts(db)
         await db.commit()
 
+        if wide_posts or fts_outdated:
+            # Otherwise the file keeps the size it had before compacting
+            logger.info('Shrinking the db file')
+            await db.execute('VACUUM;')
+
+
+async def schema_is_current() -> bool:
+    # Whether create_db would leave the db as it is, checked without changing anything
+    if not os.path.exists(DB_PATH):
+        return False
+    async with aiosqlite.connect(DB_PATH) as db:
+        for table, create_sql in TABLES:
+            with closing(sqlite3.connect(':memory:')) as memory_db:
+                memory_db.execute(create_sql)
+                expected_columns = {
+                    row[1] for row in memory_db.execute(f'PRAGMA table_info({table});')
+                }
+            if set(await _get_columns(db, table)) != expected_columns:
+                return False
+
+        cursor = await db.execute(
+            "SELECT name, sql FROM sqlite_master WHERE name IN"
+            " ('posts_fts', 'posts_status_idx', 'post_characters_character_idx');"
+        )
+        schema = dict(await cursor.fetchall())
+    return len(schema) == 3 and "content=''" in schema['posts_fts']
+
+
+async def _intern(
+    db: aiosqlite.Connection, table: str, id_column: str, column: str, values: set[str]
+) -> dict[str, int]:
+    # Adds values that aren't in the lookup table yet and returns ids of all of them
+    await db.executemany(
+        f'INSERT INTO {table} ({column}) VALUES (?) ON CONFLICT ({column}) DO NOTHING;',
+        [(value,) for value in values]
+    )
+    ids = {}
+    for chunk in _chunks(list(values)):
+        cursor = await db.execute(
+            f'SELECT {column}, {id_column} FROM {table}'
+            f' WHERE {column} IN ({",".join("?" * len(chunk))});',
+            chunk
+        )
+        ids.update(await cursor.fetchall())
+    return ids
+
+
+async def save_posts(
+    db: aiosqlite.Connection, posts: list[dict], keep_status: bool = False
+) -> int:
+    """
+    Saves posts in the same form that get_posts returns them, with pipeline and status
+    of each post. Posts that are already saved exactly like that aren't touched.
+    With keep_status, statuses of posts that are already saved aren't changed.
+    Doesn't commit. Returns how many posts were inserted or changed.
+    """
+    saved = {}
+    for pipeline in {post['pipeline'] for post in posts}:
+        post_ids = [post['id'] for post in posts if post['pipeline'] == pipeline]
+        for chunk in _chunks(post_ids):
+            cursor = await db.execute(
+                f'{SQL_SELECT_POSTS} WHERE posts.pipeline = ?'
+                f' AND posts.id IN ({",".join("?" * len(chunk))});',
+                (pipeline, *chunk)
+            )
+            for row in await cursor.fetchall():
+                saved[pipeline, row[0]] = {**_post_from_row(row), 'pipeline': pipeline}
+
+    def is_saved(post: dict) -> bool:
+        saved_post = saved.get((post['pipeline'], post['id']))
+        if saved_post is not None and keep_status:
+            post = {**post, 'status': saved_post['status']}
+        return saved_post == {key: post[key] for key in POST_KEYS}
+
+    posts = [post for post in posts if not is_saved(post)]
+    if not posts:
+        return 0
+
+    artist_ids = await _intern(
+        db, 'artists', 'artist_id', 'name', {post['artist'] for post in posts}
+    )
+    character_ids = await _intern(
+        db, 'characters', 'character_id', 'tag',
+        {tag for post in posts for tag in post['characters'].split()}
+    )
+
+    # Upserting instead of replacing, so that uid of existing posts stays the same
+    update_status = '' if keep_status else 'status = excluded.status,'
+    await db.executemany(
+        f"""INSERT INTO posts
+        (id, status, md5, file_ext, has_large, file_url, preview_url, url, artist_id, source,
+            pipeline)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (pipeline, id) DO UPDATE SET
+            {update_status}
+            md5 = excluded.md5,
+            file_ext = excluded.file_ext,
+            has_large = excluded.has_large,
+            file_url = excluded.file_url,
+            preview_url = excluded.preview_url,
+            url = excluded.url,
+            artist_id = excluded.artist_id,
+            source = excluded.source;""",
+        [
+            (
+                post['id'],
+                post['status'],
+                *_compact_urls(post),
+                artist_ids[post['artist']],
+                post['source'],
+                post['pipeline'],
+            )
+            for post in posts
+        ]
+    )
+
+    uids = {}
+    for pipeline in {post['pipeline'] for post in posts}:
+        post_ids = [post['id'] for post in posts if post['pipeline'] == pipeline]
+        for chunk in _chunks(post_ids):
+            cursor = await db.execute(
+                'SELECT id, uid FROM posts'
+                f' WHERE pipeline = ? AND id IN ({",".join("?" * len(chunk))});',
+                (pipeline, *chunk)
+            )
+            uids.update(((pipeline, post_id), uid) for post_id, uid in await cursor.fetchall())
+
+    await db.executemany(
+        'DELETE FROM post_characters WHERE post_uid = ?;',
+        [(uids[post['pipeline'], post['id']],) for post in posts]
+    )
+    await db.executemany(
+        'INSERT INTO post_characters (post_uid, position, character_id) VALUES (?, ?, ?);',
+        [
+            (uids[post['pipeline'], post['id']], position, character_ids[tag])
+            for post in posts
+            for position, tag in enumerate(post['characters'].split())
+        ]
+    )
+    # Contentless table can only forget a row if it's given the texts that were indexed
+    await db.executemany(
+        "INSERT INTO posts_fts (posts_fts, rowid, artist, characters) VALUES ('delete', ?, ?, ?);",
+        [
+            (uids[post['pipeline'], post['id']], saved_post['artist'], saved_post['characters'])
+            for post in posts
+            if (saved_post := saved.get((post['pipeline'], post['id'])))
+        ]
+    )
+    await db.executemany(
+        'INSERT INTO posts_fts (rowid, artist, characters) VALUES (?, ?, ?);',
+        [
+            (uids[post['pipeline'], post['id']], post['artist'], post['characters'])
+            for post in posts
+        ]
+    )
+    return len(posts)
+
 
 async def add_posts(
+    pipeline: str,
     posts: list[dict] | dict,
     status: Literal['no_rating', 'to_post', 'deleted'] = 'no_rating'
 ) -> None:
     if isinstance(posts, dict):
         posts = [posts]
 
-    multiple_columns = []
-    for post in posts:
-        multiple_columns.append(
-            (
-                post['id'],
-                status,
-                post['preview_url'],
-                post['file_url'],
-                post['artist'],
-                post['characters'],
-                post['url'],
-                post['source'],
-            )
-        )
-
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.executemany(
-            'INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
-            multiple_columns
-        )
+        await save_posts(db, [{**post, 'status': status, 'pipeline': pipeline} for post in posts])
         await db.commit()
 
 
 async def update_posts_status(
+    pipeline: str,
     post_ids: list[int] | int,
     status: Literal['no_rating', 'to_post', 'deleted'] = 'no_rating'
 ) -> None:
     if isinstance(post_ids, int):
         post_ids = [post_ids]
 
-    multiple_columns = [(status, post_id) for post_id in post_ids]
+    multiple_columns = [(status, pipeline, post_id) for post_id in post_ids]
     async with aiosqlite.connect(DB_PATH) as db:
         await db.executemany(
-            'UPDATE posts SET status = ? WHERE id = ?;',
+            'UPDATE posts SET status = ? WHERE pipeline = ? AND id = ?;',
             multiple_columns
         )
         await db.commit()
 
 
-async def get_posts() -> list[dict]:
+async def set_posts_statuses(
+    pipeline: str,
+    statuses: dict[int, Literal['no_rating', 'to_post', 'deleted']]
+) -> None:
+    # Same as update_posts_status, but every post can have its own status
+    multiple_columns = [(status, pipeline, post_id) for post_id, status in statuses.items()]
     async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute('SELECT * FROM posts;')
+        await db.executemany(
+            'UPDATE posts SET status = ? WHERE pipeline = ? AND id = ?;',
+            multiple_columns
+        )
+        await db.commit()
+
+
+async def update_posts_metadata(
+    pipeline: str, posts: list[dict], gone_post_ids: list[int]
+) -> None:
+    """
+    Saves posts that were changed on Danbooru and marks posts that were removed
+    from there as deleted, all in one transaction.
+    Statuses of changed posts are kept, they could have been rated during the refresh.
+    """
+    async with aiosqlite.connect(DB_PATH) as db:
+        await save_posts(db, [{**post, 'pipeline': pipeline} for post in posts], keep_status=True)
+        await db.executemany(
+            "UPDATE posts SET status = 'deleted' WHERE pipeline = ? AND id = ?;",
+            [(pipeline, post_id) for post_id in gone_post_ids]
+        )
+        await db.commit()
+
+
+def _post_from_row(row) -> dict:
+    # Takes a row of SQL_SELECT_POSTS
+    # TODO: Make this a msgspec object
+    file_url, preview_url, url = _render_urls(row[0], *row[2:8])
+    return {
+        'id': row[0],
+        'status': row[1],
+        'preview_url': preview_url,
+        'file_url': file_url,
+        'artist': row[8],
+        'characters': row[9],
+        'url': url,
+        'source': row[10],
+    }
+
+
+async def iter_posts(db: aiosqlite.Connection, chunk_size: int = 1000) -> AsyncIterator[dict]:
+    # Every post of every pipeline, with its pipeline
+    cursor = await db.execute(f'{SQL_SELECT_POSTS} ORDER BY posts.uid;')
+    # Rows are fetched from the db thread in chunks instead of one by one
+    cursor.arraysize = chunk_size
+    async for row in cursor:
+        yield {**_post_from_row(row), 'pipeline': row[11]}
+
+
+async def get_posts(pipeline: str) -> list[dict]:
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute(f'{SQL_SELECT_POSTS} WHERE posts.pipeline = ?;', (pipeline,))
+        result = await cursor.fetchall()
+
+    return [_post_from_row(post) for post in result]
+
+
+async def get_posts_by_statuses(
+    pipeline: str, statuses: tuple[Literal['no_rating', 'to_post', 'deleted'], ...]
+) -> list[dict]:
+    placeholders = ','.join('?' * len(statuses))
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute(
+            f'{SQL_SELECT_POSTS} WHERE posts.pipeline = ? AND posts.status IN ({placeholders});',
+            (pipeline, *statuses)
+        )
         result = await cursor.fetchall()
 
-    posts = []
-    for post in result:
-        # TODO: Make this a msgspec object
-        new_post = {
-            'id': post[0],
-            'status': post[1],
-            'preview_url': post[2],
-            'file_url': post[3],
-            'artist': post[4],
-            'characters': post[5],
-            'url': post[6],
-            'source': post[7],
-        }
-        posts.append(new_post)
-    return posts
-
-
-async def get_post(post_id) -> dict:
+    return [_post_from_row(post) for post in result]
+
+
+async def get_reviewed_post_ids(pipeline: str) -> set[int]:
+    # Only reads posts_status_idx, not the posts themselves
     async with aiosqlite.connect(DB_PATH) as db:
         cursor = await db.execute(
-            'SELECT * FROM posts WHERE id = ?;', (post_id,)
+            "SELECT id FROM posts WHERE pipeline = ? AND status != 'no_rating';", (pipeline,)
+        )
+        result = await cursor.fetchall()
+
+    return {post_id for post_id, in result}
+
+
+async def get_post(pipeline: str, post_id) -> dict:
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute(
+            f'{SQL_SELECT_POSTS} WHERE posts.pipeline = ? AND posts.id = ?;', (pipeline, post_id)
         )
         result = await cursor.fetchone()
 
-    # TODO: Make this a msgspec object
-    post = {
-        'id': result[0],
-        'status': result[1],
-        'preview_url': result[2],
-        'file_url': result[3],
-        'artist': result[4],
-        'characters': result[5],
-        'url': result[6],
-        'source': result[7],
-    }
-    return post
+    return _post_from_row(result)
 
 
-async def posts_exists(post_id) -> bool:
+async def get_posts_by_ids(pipeline: str, post_ids: list[int]) -> list[dict]:
+    # Order of the returned posts is not guaranteed
+    placeholders = ','.join('?' * len(post_ids))
     async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute('SELECT id FROM posts WHERE id = ?;', (post_id,))
+        cursor = await db.execute(
+            f'{SQL_SELECT_POSTS} WHERE posts.pipeline = ? AND posts.id IN ({placeholders});',
+            (pipeline, *post_ids)
+        )
+        result = await cursor.fetchall()
+
+    return [_post_from_row(post) for post in result]
+
+
+async def get_posts_page(
+    pipeline: str,
+    status: Literal['no_rating', 'to_post', 'deleted'] | None = None,
+    match: str | None = None,
+    before_id: int | None = None,
+    limit: int = 10,
+) -> list[dict]:
+    """
+    Returns posts from newest to oldest, starting right after `before_id`.
+    Pass id of the last returned post as `before_id` to get the next page.
+    `match` is an FTS5 query over artist and characters columns.
+    """
+    conditions = ['posts.pipeline = ?']
+    params = [pipeline]
+    if status:
+        conditions.append('posts.status = ?')
+        params.append(status)
+    if before_id is not None:
+        conditions.append('posts.id < ?')
+        params.append(before_id)
+    if match:
+        conditions.append('posts.uid IN (SELECT rowid FROM posts_fts WHERE posts_fts MATCH ?)')
+        params.append(match)
+
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute(
+            f'{SQL_SELECT_POSTS} WHERE {" AND ".join(conditions)}'
+            ' ORDER BY posts.id DESC LIMIT ?;',
+            (*params, limit)
+        )
+        result = await cursor.fetchall()
+
+    return [_post_from_row(post) for post in result]
+
+
+async def posts_exists(pipeline: str, post_id) -> bool:
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute(
+            'SELECT id FROM posts WHERE pipeline = ? AND id = ?;', (pipeline, post_id)
+        )
         return (await cursor.fetchone()) is not None
 
 
-async def create_search(post_ids: list[int]) -> int:
+async def create_search(pipeline: str, post_ids: list[int]) -> int:
     # Returns the search id of the newly created search
     post_ids_str = [str(post_id) for post_id in post_ids]
     posts_formatted = ','.join(post_ids_str)
     async with aiosqlite.connect(DB_PATH) as db:
         cur = await db.execute(
-            'INSERT INTO searches (search_posts) VALUES (?) RETURNING search_id;',
-            (posts_formatted,)
+            'INSERT INTO searches (search_posts, pipeline) VALUES (?, ?) RETURNING search_id;',
+            (posts_formatted, pipeline)
         )
         search_id_row = await cur.fetchone()
         search_id = search_id_row[0]
@@ -161,16 +654,27 @@ async def create_search(post_ids: list[int]) -> int:
     return search_id
 
 
-async def get_search_posts(search_id: int) -> list[int]:
+async def update_search_posts(search_id: int, post_ids: list[int]) -> None:
+    # Used when more posts are found after the search was created
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            'UPDATE searches SET search_posts = ? WHERE search_id = ?;',
+            (','.join(str(post_id) for post_id in post_ids), search_id)
+        )
+        await db.commit()
+
+
+async def get_search(search_id: int) -> tuple[str, list[int]]:
+    # Returns the pipeline of the search and its posts
     async with aiosqlite.connect(DB_PATH) as db:
         cursor = await db.execute(
-            'SELECT search_posts FROM searches WHERE search_id = ?;',
+            'SELECT pipeline, search_posts FROM searches WHERE search_id = ?;',
             (search_id,)
         )
         results = await cursor.fetchone()
-    posts_str = results[0].split(',')
+    posts_str = results[1].split(',')
     posts = [int(post) for post in posts_str]
-    return posts
+    return results[0], posts
 
 
 async def delete_search(search_id: int) -> None:
@@ -179,29 +683,55 @@ async def delete_search(search_id: int) -> None:
         await db.commit()
 
 
-async def save_uploaded_attachment(post_id: int, attachment_string: str) -> None:
+async def save_uploaded_attachment(
+    pipeline: str, post_id: int, attachment_string: str
+) -> None:
     async with aiosqlite.connect(DB_PATH) as db:
         await db.execute(
-            "INSERT INTO vk_attachments (id, attachment) VALUES (?, ?)",
-            (post_id, attachment_string,)
+            "INSERT INTO vk_attachments (id, attachment, pipeline) VALUES (?, ?, ?)",
+            (post_id, attachment_string, pipeline,)
         )
         await db.commit()
 
 
-async def get_post_attachment(post_id: int) -> str | None:
+async def get_post_attachment(pipeline: str, post_id: int) -> str | None:
     async with aiosqlite.connect(DB_PATH) as db:
         cursor = await db.execute(
-            'SELECT attachment FROM vk_attachments WHERE id = ?;',
-            (post_id,)
+            'SELECT attachment FROM vk_attachments WHERE pipeline = ? AND id = ?;',
+            (pipeline, post_id)
         )
         results = await cursor.fetchone()
         return (results[0] if results else None)
 
 
+async def get_posts_attachments(pipeline: str, post_ids: list[int]) -> dict[int, str]:
+    placeholders = ','.join('?' * len(post_ids))
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute(
+            'SELECT id, attachment FROM vk_attachments'
+            f' WHERE pipeline = ? AND id IN ({placeholders});',
+            (pipeline, *post_ids)
+        )
+        results = await cursor.fetchall()
+    return {post_id: attachment for post_id, attachment in results}
+
+
+async def get_recent_attachments(pipeline: str, limit: int) -> dict[int, str]:
+    # Attachments of the newest posts, these are the most likely to be shown again
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute(
+            'SELECT id, attachment FROM vk_attachments WHERE pipeline = ?'
+            ' ORDER BY id DESC LIMIT ?;',
+            (pipeline, limit)
+        )
+        results = await cursor.fetchall()
+    return {post_id: attachment for post_id, attachment in results}
+
+
 async def main():
     # Example usage
     await create_db()
-    a = await get_posts()
+    a = await get_posts(PIPELINES[0].name)
     print(a)
 
 
@@ -0,0 +1,200 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import io
+from typing import AsyncIterator, BinaryIO, Iterator
+
+import aiosqlite
+import msgspec
+from loguru import logger
+
+from config import DB_PATH
+from db import create_db, iter_posts, save_posts, schema_is_current
+
+# Tables that can be dumped and columns that identify their rows
+DUMP_TABLES = {
+    'posts': ('pipeline', 'id'),
+    'searches': ('search_id',),
+    'vk_attachments': ('pipeline', 'id'),
+}
+DUMP_CHUNK_SIZE = 1000
+
+
+def _open_dump(path: str, mode: str) -> BinaryIO:
+    # Files that end with .zst are compressed with zstd
+    f = open(path, mode + 'b')
+    if not path.endswith('.zst'):
+        return f
+
+    try:
+        import zstandard
+    except ImportError:
+        f.close()
+        raise SystemExit(
+            'zstandard is needed for .zst files, install it with "pip install zstandard"'
+        )
+
+    if mode == 'w':
+        return zstandard.ZstdCompressor().stream_writer(f)
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+
+
+async def iter_table(db: aiosqlite.Connection, table: str) -> AsyncIterator[dict]:
+    if table == 'posts':
+        # Posts are dumped the way get_posts returns them, so dumps don't depend on the schema
+        async for post in iter_posts(db, DUMP_CHUNK_SIZE):
+            yield post
+        return
+
+    cursor = await db.execute(f'SELECT * FROM {table};')
+    # Rows are fetched from the db thread in chunks instead of one by one
+    cursor.arraysize = DUMP_CHUNK_SIZE
+    columns = [column[0] for column in cursor.description]
+    async for row in cursor:
+        yield dict(zip(columns, row))
+
+
+async def export_db(path: str, tables: list[str]) -> None:
+    encoder = msgspec.json.Encoder()
+    async with aiosqlite.connect(DB_PATH) as db:
+        with _open_dump(path, 'w') as f:
+            for table in tables:
+                count = 0
+                async for row in iter_table(db, table):
+                    f.write(encoder.encode({'table': table, 'row': row}) + b'\n')
+                    count += 1
+                logger.info(f'Exported {count} rows from "{table}"')
+
+
+def iter_dump(path: str) -> Iterator[tuple[str, dict]]:
+    decoder = msgspec.json.Decoder()
+    with _open_dump(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = decoder.decode(line)
+            yield entry['table'], entry['row']
+
+
+def _upsert_sql(table: str, columns: list[str]) -> str:
+    # Rows that are already the same aren't touched, so changes can be counted
+    keys = DUMP_TABLES[table]
+    other_columns = [column for column in columns if column not in keys]
+    placeholders = ', '.join('?' * len(columns))
+    sql = (
+        f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders})'
+        f' ON CONFLICT ({", ".join(keys)}) DO '
+    )
+    if not other_columns:
+        return sql + 'NOTHING;'
+    return sql + (
+        'UPDATE SET '
+        + ', '.join(f'{column} = excluded.{column}' for column in other_columns)
+        + ' WHERE '
+        + ' OR '.join(f'{table}.{column} IS NOT excluded.{column}' for column in other_columns)
+        + ';'
+    )
+
+
+async def _write_chunk(
+    db: aiosqlite.Connection, table: str, columns: list[str], rows: list[tuple]
+) -> int:
+    # Returns how many rows were inserted or changed
+    if table == 'posts':
+        return await save_posts(db, [dict(zip(columns, row)) for row in rows])
+
+    changes_before = db.total_changes
+    await db.executemany(_upsert_sql(table, columns), rows)
+    return db.total_changes - changes_before
+
+
+async def import_db(path: str, dry_run: bool = False) -> None:
+    """
+    Imports rows from a dump. Importing the same dump again changes nothing.
+    With `dry_run`, everything is rolled back and only the counts are shown.
+    """
+    if not dry_run:
+        await create_db()
+    elif not await schema_is_current():
+        # Migrations are committed, so they can't be a part of a dry run
+        raise SystemExit(
+            'The db is missing or has an old schema, start the bot once'
+            ' or import without --dry-run to migrate it'
+        )
+
+    chunks: dict[str, tuple[list[str], list[tuple]]] = {}
+    read: dict[str, int] = {table: 0 for table in DUMP_TABLES}
+    changed: dict[str, int] = {table: 0 for table in DUMP_TABLES}
+
+    async with aiosqlite.connect(DB_PATH) as db:
+        async def write(table: str) -> None:
+            columns, rows = chunks.pop(table)
+            changed[table] += await _write_chunk(db, table, columns, rows)
+            if not dry_run:
+                await db.commit()
+
+        for table, row in iter_dump(path):
+            if table not in DUMP_TABLES:
+                logger.warning(f'Skipping row of unknown table "{table}"')
+                continue
+
+            columns = list(row)
+            if table in chunks and chunks[table][0] != columns:
+                await write(table)
+            chunks.setdefault(table, (columns, []))[1].append(tuple(row.values()))
+            read[table] += 1
+            if len(chunks[table][1]) >= DUMP_CHUNK_SIZE:
+                await write(table)
+
+        for table in list(chunks):
+            await write(table)
+
+        if dry_run:
+            await db.rollback()
+
+    for table in DUMP_TABLES:
+        logger.info(
+            f'"{table}": {read[table]} rows read, {changed[table]} rows'
+            f' {"would be" if dry_run else "were"} inserted or changed'
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description='Streams the db to and from JSON lines, files ending with .zst are compressed'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('path')
+    export_parser.add_argument(
+        '--tables', nargs='+', choices=list(DUMP_TABLES), default=list(DUMP_TABLES)
+    )
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        await export_db(args.path, args.tables)
+    else:
+        await import_db(args.path, args.dry_run)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
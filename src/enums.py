@@ -28,3 +28,7 @@ class PostAction(Enum):
 class SearchAction(Enum):
     POST = "post"
     CANCEL = "cancel"
+
+
+class HistoryAction(Enum):
+    NEXT_PAGE = "history_next"
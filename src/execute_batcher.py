@@ -0,0 +1,111 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Any
+
+import msgspec
+from loguru import logger
+from vkbottle import API, VKAPIError
+
+from config import EXECUTE_BATCH_WINDOW, EXECUTE_CALL_TIMEOUT
+
+# VK doesn't allow more than 25 API calls in one execute
+EXECUTE_MAX_CALLS = 25
+
+
+def _execute_error(method: str, error: dict) -> VKAPIError:
+    # Errors of execute can lack fields their exceptions require, e.g. captcha_sid of CaptchaError
+    error = dict(error)
+    code = error.pop('error_code', 0)
+    error.setdefault('error_msg', f'{method} failed in execute')
+    try:
+        return VKAPIError[code](**error)
+    except Exception:
+        return VKAPIError(error_msg=f'[{code}] {error["error_msg"]}')
+
+
+class ExecuteBatcher:
+    """
+    Collects VK API calls made within `window` seconds of each other and sends them
+    as one execute request. Every caller gets its own result or its own VKAPIError back.
+    """
+    def __init__(self, api: API, window: float = EXECUTE_BATCH_WINDOW):
+        self.api = api
+        self.window = window
+        self.encoder = msgspec.json.Encoder()
+        self._pending: list[tuple[str, dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def call(self, method: str, params: dict[str, Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Lists, bools and Nones are converted the same way vkbottle does it
+        params = await self.api.validate_request(dict(params))
+        self._pending.append((method, params, future))
+
+        if len(self._pending) >= EXECUTE_MAX_CALLS:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_flush)
+        # A timed out future is cancelled, so _flush skips it
+        return await asyncio.wait_for(future, EXECUTE_CALL_TIMEOUT)
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch = self._pending[:EXECUTE_MAX_CALLS]
+            del self._pending[:EXECUTE_MAX_CALLS]
+            task = asyncio.create_task(self._flush(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch: list[tuple[str, dict, asyncio.Future]]) -> None:
+        calls = ','.join(
+            f'API.{method}({self.encoder.encode(params).decode()})' for method, params, _ in batch
+        )
+        logger.info(f'Sending {len(batch)} VK API calls in one execute')
+        try:
+            response = await self.api.request('execute', {'code': f'return [{calls}];'})
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        try:
+            # Failed calls return false, their errors are listed in the same order
+            errors = iter(response.get('execute_errors', []))
+            for (method, _, future), result in zip(batch, response['response']):
+                if future.done():
+                    continue
+                if result is False:
+                    future.set_exception(_execute_error(method, next(errors, {})))
+                else:
+                    future.set_result(result)
+        except Exception:
+            logger.exception(f'Failed to read results of execute: {response!r}')
+        finally:
+            # Nobody would wake up callers whose results are missing or weren't set
+            for method, _, future in batch:
+                if not future.done():
+                    future.set_exception(
+                        VKAPIError(error_msg=f'{method} got no result from execute')
+                    )
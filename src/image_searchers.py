@@ -17,17 +17,38 @@
 
 import asyncio
 
-import booru
 import msgspec
 
+from config import DANBOORU_MAX_CONCURRENT_REQUESTS
+
+# booru raises a bare Exception with this message instead of returning an empty list
+BOORU_NO_RESULTS_ERROR = 'no results, make sure you spelled everything right'
+
 
 class DanbooruSearcher:
-    def __init__(self):
-        self.dan = booru.Danbooru()
+    # One searcher is shared by all pipelines, so it limits how many requests run at once
+    def __init__(self, max_concurrent_requests: int = DANBOORU_MAX_CONCURRENT_REQUESTS):
+        self._dan = None
         self.decoder = msgspec.json.Decoder()
+        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    @property
+    def dan(self):
+        # booru imports clients of every booru it supports, so it's imported when needed
+        if self._dan is None:
+            import booru
+            self._dan = booru.Danbooru()
+        return self._dan
 
-    async def search(self, query: str, block: str = '', limit: int = 100) -> list[dict]:
-        res = await self.dan.search(query=query, block=block, limit=limit, random=False)
+    async def search(self, query: str, limit: int = 100, page: int = 1) -> list[dict]:
+        # Returns an empty list if nothing was found, e.g. for pages after the last one
+        async with self.semaphore:
+            try:
+                res = await self.dan.search(query=query, limit=limit, page=page, random=False)
+            except Exception as e:
+                if str(e) == BOORU_NO_RESULTS_ERROR:
+                    return []
+                raise
         return self.decoder.decode(res)
 
 
@@ -15,117 +15,303 @@
 # You should have received a copy of the GNU General Public License
 # along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
 
+# Taken before anything else is imported, so that reported startup time includes imports
+import time
+_started = time.perf_counter()
+
 import asyncio
 import datetime
+import functools
 import logging
-import time
+from typing import AsyncIterator, Literal
 
 from loguru import logger
-from vkbottle import Callback, GroupEventType, Keyboard
+from vkbottle import API, Callback, GroupEventType, Keyboard
 from vkbottle import KeyboardButtonColor as Color
-from vkbottle import User
+from vkbottle import User, run_multibot
 from vkbottle.bot import Bot, Message, MessageEvent, rules
-from vkbottle.tools import PhotoMessageUploader, PhotoWallUploader
+from vkbottle.tools import DocMessagesUploader, PhotoMessageUploader, PhotoWallUploader
 
 from config import (
-    ADMIN_IDS,
-    GROUP_ID,
-    HU_TAO_QUERY,
-    VK_API_TOKEN,
+    CALLBACK_DEDUP_TTL,
+    CALLBACK_SERVER_PORT,
+    CASSETTE_RECORD_PATH,
+    PIPELINES,
+    PIPELINES_BY_GROUP,
+    PROFILE_MAX_SECONDS,
+    SEARCH_BATCH_SIZE,
     VK_USER_API_TOKEN,
-    post_interval
+    Pipeline
 )
 from db import (
     add_posts,
-    create_db,
     create_search,
     delete_search,
-    get_posts,
-    update_posts_status
+    get_posts_by_statuses,
+    update_posts_status,
+    update_search_posts
 )
-from enums import PostAction, SearchAction
+from enums import HistoryAction, PostAction, SearchAction
+from execute_batcher import ExecuteBatcher
 from image_searchers import DanbooruSearcher
+from profiler import is_profiling, profile
+from publish_schedule import get_publish_schedule
+from search_session import (
+    SearchSession,
+    close_search_session,
+    get_search_session,
+    register_search_session
+)
+from single_flight import SingleFlight
+from startup import StartupTimer, start
 from utils import (
-    characters_to_tags,
     create_text,
-    get_last_posts,
+    get_attachment,
+    get_history_page,
     get_last_rerun_day,
-    get_modified_from_search,
-    get_rerun_day,
-    run_search,
+    iter_new_posts,
+    refresh_posts,
+    run_in_background,
+    show_search,
     set_last_rerun_day,
     upload_wall_photo
 )
 
 logging.getLogger('aiosqlite').setLevel(logging.INFO)
 
-bot = Bot(VK_API_TOKEN)
+# Every pipeline has its own group, but they all share the handlers below,
+# the user account, the Danbooru searcher and vkbottle's http client
+pipeline_apis = {pipeline.name: API(pipeline.token) for pipeline in PIPELINES}
+bot = Bot(api=pipeline_apis[PIPELINES[0].name])
 user = User(VK_USER_API_TOKEN)
-photo_msg_upl = PhotoMessageUploader(bot.api)
+photo_msg_upls = {name: PhotoMessageUploader(api) for name, api in pipeline_apis.items()}
 photo_wall_upl = PhotoWallUploader(user.api)
+doc_msg_upls = {name: DocMessagesUploader(api) for name, api in pipeline_apis.items()}
+user_execute = ExecuteBatcher(user.api)
 dan = DanbooruSearcher()
+callback_flights = SingleFlight(ttl=CALLBACK_DEDUP_TTL)
 bot.labeler.vbml_ignore_case = True
 
 
+def get_admin_pipeline(group_id: int | None, user_id: int) -> Pipeline | None:
+    # Returns pipeline of the group, but only if the user is one of its admins
+    pipeline = PIPELINES_BY_GROUP.get(group_id)
+    if pipeline is None or user_id not in pipeline.admin_ids:
+        return None
+    return pipeline
+
+
+async def get_pipeline_session(search_id: int, pipeline: Pipeline) -> SearchSession | None:
+    # Searches can only be changed from the group they were started in
+    session = await get_search_session(search_id)
+    if session.pipeline != pipeline.name:
+        return None
+    return session
+
+
+def dedup_callback(handler):
+    # Repeated presses of the same button share one run of the handler
+    @functools.wraps(handler)
+    async def wrapper(event: MessageEvent):
+        pipeline = get_admin_pipeline(event.group_id, event.user_id)
+        if pipeline is None:
+            return
+
+        # Whole payload is the key: search, offset and action for review buttons.
+        # History payloads are the same for everyone, so the chat is a part of the key too
+        key = (
+            event.group_id,
+            event.peer_id,
+            *sorted(event.get_payload_json().items()),
+        )
+        return await callback_flights.do(key, lambda: handler(event, pipeline))
+    return wrapper
+
+
+# These have to be registered before search_tao_handler, otherwise
+# "история", "обновить" and "план" would be treated as custom searches
+@bot.on.private_message(
+    text=(
+        '.hu tao history',
+        '.ху тао история',
+        '.hu tao history <filters>',
+        '.ху тао история <filters>',
+    )
+)
+async def history_handler(message: Message, filters: str = ''):
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
+        return
+
+    history_page = await get_history_page(pipeline, filters)
+    await message.answer(history_page['message'], keyboard=history_page['keyboard'])
+
+
+@bot.on.private_message(text=('.hu tao refresh', '.ху тао обновить'))
+async def refresh_handler(message: Message):
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
+        return
+
+    posts = await get_posts_by_statuses(pipeline.name, ('no_rating', 'to_post'))
+    await message.answer(f'🔄 Проверяем {len(posts)} постов на Danbooru...')
+    try:
+        changed_posts, gone_post_ids = await refresh_posts(dan, pipeline, posts)
+    except Exception as e:
+        logger.exception(f"Couldn't refresh posts: {e}")
+        return '❌ Не удалось проверить посты на Danbooru, попробуйте позже.'
+    return (
+        f'✅ Готово! Изменилось постов: {len(changed_posts)},'
+        f' удалено с Danbooru: {len(gone_post_ids)}.'
+    )
+
+
+@bot.on.private_message(
+    text=('.hu tao plan', '.ху тао план', '.hu tao plan <count:int>', '.ху тао план <count:int>')
+)
+async def publish_plan_handler(message: Message, count: int = SEARCH_BATCH_SIZE):
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
+        return
+
+    schedule = await get_publish_schedule(user.api, pipeline)
+    plan = schedule.plan(min(count, 50))
+    lines = [
+        f'{rerun_day} день: ' + (
+            datetime.datetime.fromtimestamp(publish_date).strftime('%d.%m %H:%M')
+            if publish_date else 'сразу'
+        )
+        for publish_date, rerun_day in plan
+    ]
+    return (
+        f'🗓 В отложке {len(schedule.slots)} постов. Следующие посты выйдут так:\n'
+        + '\n'.join(lines)
+    )
+
+
+@bot.on.raw_event(
+    GroupEventType.MESSAGE_EVENT,
+    MessageEvent,
+    rules.PayloadMapRule([
+        ('cmd', HistoryAction.NEXT_PAGE.value),
+        ('before_id', int),
+        ('filters', str)
+    ])
+)
+@dedup_callback
+async def history_next_page_handler(event: MessageEvent, pipeline: Pipeline):
+    payload = event.get_payload_json()
+    history_page = await get_history_page(pipeline, payload['filters'], payload['before_id'])
+    await event.edit_message(
+        peer_id=event.peer_id,
+        message=history_page['message'],
+        keyboard=history_page['keyboard']
+    )
+
+
 @bot.on.private_message(
     text=('.hu tao', '.ху тао', '.hu tao <custom_search>', '.ху тао <custom_search>')
 )
 async def search_tao_handler(message: Message, custom_search: str | None = None):
-    if message.from_id not in ADMIN_IDS:
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
         return
 
+    # Search starts while the "searching" message is being sent
+    new_posts = iter_new_posts(dan, pipeline, custom_search or pipeline.query)
+    first_posts_task = asyncio.create_task(anext(new_posts, None))
     msg_to_edit = await message.answer('🔎 Ищем, пожалуйста подождите...')
+    first_posts = await first_posts_task
 
-    existing_posts = await get_posts()
-    reviewed_posts_ids = [post['id'] for post in existing_posts if post['status'] != 'no_rating']
-    new_posts = await dan.search(custom_search or HU_TAO_QUERY, limit=10)
-    show_posts = []
-    for post in new_posts:
-        if post['id'] in reviewed_posts_ids:
-            continue
-
-        try:
-            formatted_characters = characters_to_tags(post['tag_string_character'])
-            show_posts.append(
-                {
-                    'id': post['id'],
-                    'preview_url': post['large_file_url'],
-                    'file_url': post['file_url'],
-                    'artist': post['tag_string_artist'],
-                    'characters': formatted_characters,
-                    'url': post['post_url'],
-                    'source': post['source'],
-                }
+    if not first_posts:
+        await message.ctx_api.messages.edit(
+            peer_id=message.peer_id,
+            conversation_message_id=msg_to_edit.conversation_message_id,
+            message=(
+                f'🤔 Новых артов с {pipeline.character_name} не нашлось! Все просмотренные арты'
+                ' можно найти с помощью команды ".Ху Тао история"'
             )
-        except KeyError:
-            # Some posts don't have some of the keys for some reason
-            continue
-        logger.info(f'Found new post (by {post["tag_string_artist"]}): {post["post_url"]}')
+        )
+        return
 
-    await add_posts(show_posts)
+    # First post is shown as soon as its page is checked, the rest is found in the background.
+    # Its photo starts uploading right away, show_search joins that upload.
+    uploader = photo_msg_upls[pipeline.name]
+    run_in_background(prepare_attachment(uploader, pipeline, message.peer_id, first_posts[0]))
+    _, search_id = await asyncio.gather(
+        add_posts(pipeline.name, first_posts),
+        create_search(pipeline.name, [post['id'] for post in first_posts]),
+    )
+    session = await register_search_session(search_id, pipeline.name, first_posts)
+    run_in_background(find_more_posts(pipeline, session, new_posts, uploader, message.peer_id))
 
-    if not show_posts:
-        await bot.api.messages.edit(
+    async def edit(text: str, photo: str | None, keyboard: str | None):
+        await message.ctx_api.messages.edit(
             peer_id=message.peer_id,
             conversation_message_id=msg_to_edit.conversation_message_id,
-            message=(
-                '🤔 Новых артов с Ху Тао не нашлось! Все просмотренные арты можно'
-                ' найти с помощью команды ".Ху Тао история" (пока не работает)'
-            )
+            message=text,
+            attachment=photo,
+            keyboard=keyboard
         )
+    await show_search(uploader, message.peer_id, session, edit)
+
+
+async def prepare_attachment(
+    uploader: PhotoMessageUploader, pipeline: Pipeline, peer_id: int, post: dict
+) -> str | None:
+    try:
+        return await get_attachment(
+            uploader, pipeline.name, peer_id, post['preview_url'], post['id']
+        )
+    except Exception as e:
+        # show_search will try again and show the post without a photo if it fails too
+        logger.info(f"Couldn't prepare an image for post {post['id']}: {e}")
+        return None
+
+
+async def find_more_posts(
+    pipeline: Pipeline,
+    session: SearchSession,
+    new_posts: AsyncIterator[list[dict]],
+    uploader: PhotoMessageUploader,
+    peer_id: int,
+) -> None:
+    # Rest of the batch is added to the search while the first post is being reviewed
+    async for posts in new_posts:
+        await add_posts(pipeline.name, posts)
+        session.extend(posts)
+        await update_search_posts(session.search_id, session.post_ids)
+
+    next_post = session.get_post(1)
+    if next_post and next_post['id'] not in session.attachments:
+        photo = await prepare_attachment(uploader, pipeline, peer_id, next_post)
+        if photo:
+            session.attachments[next_post['id']] = photo
+
+
+async def review_post(
+    event: MessageEvent, pipeline: Pipeline, status: Literal['to_post', 'deleted'] | None
+) -> None:
+    # Shared by all rating buttons, unsure post is the one without a status
+    payload = event.get_payload_json()
+    post_id, search_id, new_offset = payload['post_id'], payload['search_id'], payload['new_offset']
+    session = await get_pipeline_session(search_id, pipeline)
+    if session is None:
         return
+    if status:
+        session.set_status(post_id, status)
 
-    post_ids = [post['id'] for post in show_posts]
-    search_id = await create_search(post_ids)
-    completed_search = await run_search(photo_msg_upl, message.peer_id, search_id)
+    async def edit(text: str, photo: str | None, keyboard: str | None):
+        await event.edit_message(
+            peer_id=event.peer_id,
+            message=text,
+            attachment=photo,
+            keyboard=keyboard
+        )
+    await show_search(photo_msg_upls[pipeline.name], event.peer_id, session, edit, new_offset)
 
-    await bot.api.messages.edit(
-        peer_id=message.peer_id,
-        conversation_message_id=msg_to_edit.conversation_message_id,
-        message=completed_search['message'],
-        attachment=completed_search['photo'],
-        keyboard=completed_search['keyboard']
-    )
+    if session.should_flush():
+        await session.flush()
 
 
 @bot.on.raw_event(
@@ -138,21 +324,9 @@ async def search_tao_handler(message: Message, custom_search: str | None = None)
         ('new_offset', int)
     ])
 )
-async def good_post_handler(event: MessageEvent):
-    if event.user_id not in ADMIN_IDS:
-        return
-
-    payload = event.get_payload_json()
-    post_id, search_id, new_offset = payload['post_id'], payload['search_id'], payload['new_offset']
-    await update_posts_status(post_id, 'to_post')
-
-    search_results = await run_search(photo_msg_upl, event.peer_id, search_id, new_offset)
-    await event.edit_message(
-        peer_id=event.peer_id,
-        message=search_results['message'],
-        attachment=search_results['photo'],
-        keyboard=search_results['keyboard']
-    )
+@dedup_callback
+async def good_post_handler(event: MessageEvent, pipeline: Pipeline):
+    await review_post(event, pipeline, 'to_post')
 
 
 @bot.on.raw_event(
@@ -165,21 +339,9 @@ async def good_post_handler(event: MessageEvent):
         ('new_offset', int)
     ])
 )
-async def delete_post_handler(event: MessageEvent):
-    if event.user_id not in ADMIN_IDS:
-        return
-
-    payload = event.get_payload_json()
-    post_id, search_id, new_offset = payload['post_id'], payload['search_id'], payload['new_offset']
-    await update_posts_status(post_id, 'deleted')
-
-    search_results = await run_search(photo_msg_upl, event.peer_id, search_id, new_offset)
-    await event.edit_message(
-        peer_id=event.peer_id,
-        message=search_results['message'],
-        attachment=search_results['photo'],
-        keyboard=search_results['keyboard']
-    )
+@dedup_callback
+async def delete_post_handler(event: MessageEvent, pipeline: Pipeline):
+    await review_post(event, pipeline, 'deleted')
 
 
 @bot.on.raw_event(
@@ -192,20 +354,9 @@ async def delete_post_handler(event: MessageEvent):
         ('new_offset', int)
     ])
 )
-async def unsure_post_handler(event: MessageEvent):
-    if event.user_id not in ADMIN_IDS:
-        return
-
-    payload = event.get_payload_json()
-    search_id, new_offset = payload['search_id'], payload['new_offset']
-
-    search_results = await run_search(photo_msg_upl, event.peer_id, search_id, new_offset)
-    await event.edit_message(
-        peer_id=event.peer_id,
-        message=search_results['message'],
-        attachment=search_results['photo'],
-        keyboard=search_results['keyboard']
-    )
+@dedup_callback
+async def unsure_post_handler(event: MessageEvent, pipeline: Pipeline):
+    await review_post(event, pipeline, None)
 
 
 @bot.on.raw_event(
@@ -216,14 +367,18 @@ async def unsure_post_handler(event: MessageEvent):
         ('search_id', int)
     ])
 )
-async def end_search_handler(event: MessageEvent):
-    if event.user_id not in ADMIN_IDS:
-        return
-
+@dedup_callback
+async def end_search_handler(event: MessageEvent, pipeline: Pipeline):
     payload = event.get_payload_json()
     search_id = payload['search_id']
 
-    to_post = await get_modified_from_search(search_id, 'to_post')
+    session = await get_pipeline_session(search_id, pipeline)
+    if session is None:
+        return
+    # Photo that's still uploading shouldn't replace the confirmation
+    session.current_offset = None
+    await session.flush()
+    to_post = session.get_modified('to_post')
     to_post_count = len(to_post)
 
     confirmation_kbd = (
@@ -255,7 +410,8 @@ async def end_search_handler(event: MessageEvent):
         peer_id=event.peer_id,
         message=(
             f'➡️ Вы собираетесь запостить или оставить в отложке {to_post_count} пост{ending}.'
-            f' На данный момент в боте установлен интервал постов в {post_interval} секунд.'
+            f' На данный момент в боте установлен интервал постов в {pipeline.post_interval}'
+            ' секунд.'
             ' Продолжить?',
         ),
         keyboard=confirmation_kbd
@@ -270,52 +426,74 @@ async def end_search_handler(event: MessageEvent):
         ('search_id', int)
     ])
 )
-async def post_handler(event: MessageEvent):
-    if event.user_id not in ADMIN_IDS:
-        return
-
+@dedup_callback
+async def post_handler(event: MessageEvent, pipeline: Pipeline):
     payload = event.get_payload_json()
     search_id = payload['search_id']
 
-    to_post = await get_modified_from_search(search_id, 'to_post', sort=True)
+    session = await get_pipeline_session(search_id, pipeline)
+    if session is None:
+        return
+    to_post = session.get_modified('to_post')
     to_post_ids = [post['id'] for post in to_post]
     to_post_count = len(to_post_ids)
     await event.edit_message('⏳ Постим посты...')
 
+    # Making sure urls still work before anything is published
+    post_failed = 0
+    try:
+        changed_posts, gone_post_ids = await refresh_posts(dan, pipeline, to_post)
+    except Exception as e:
+        logger.warning(f"Couldn't refresh posts before publishing, using stored ones: {e}")
+    else:
+        changed_posts = {post['id']: post for post in changed_posts}
+        to_post = [
+            changed_posts.get(post['id'], post) for post in to_post
+            if post['id'] not in gone_post_ids
+        ]
+        post_failed += len(gone_post_ids)
+
+    await close_search_session(search_id)
     await delete_search(search_id)
-    await update_posts_status(to_post_ids, 'deleted')
+    await update_posts_status(pipeline.name, to_post_ids, 'deleted')
 
-    posts = await get_last_posts(user.api, GROUP_ID)
-    next_rerun_day = get_rerun_day(posts) + 1
-    last_post_time = posts[0]["date"]
-    post_failed = 0
+    attachments = []
     for post in to_post:
         attachment = await upload_wall_photo(photo_wall_upl, post['file_url'])
         if not attachment:
             post_failed += 1
             continue
-        text = create_text(next_rerun_day, post['artist'], post['characters'])
-        next_rerun_day += 1
-
-        # Determining when to post this post
-        current_time = int(time.time())
-        if last_post_time + post_interval < current_time:
-            # [POST_INTERVAL] seconds has passed since last post
-            publish_date = None
-        else:
-            # [POST_INTERVAL] seconds has not passed since last post
-            difference = current_time-last_post_time
-            publish_date = current_time+post_interval-difference
-        last_post_time = publish_date or current_time
-
-        await user.api.wall.post(
-            owner_id=-GROUP_ID,
-            from_group=True,
-            message=text,
-            attachments=[attachment],
-            publish_date=publish_date,
-        )
-        await asyncio.sleep(2)
+        attachments.append((post, attachment))
+
+    # Slots for the whole batch are planned at once, after the queue
+    schedule = await get_publish_schedule(user.api, pipeline)
+    plan = schedule.reserve(len(attachments))
+
+    async def publish(post: dict, attachment: str, publish_date: int | None, rerun_day: int):
+        # Posts of one batch are sent together in one or two execute requests
+        text = create_text(pipeline, rerun_day, post['artist'], post['characters'])
+        try:
+            await user_execute.call(
+                'wall.post',
+                {
+                    'owner_id': -pipeline.group_id,
+                    'from_group': True,
+                    'message': text,
+                    'attachments': [attachment],
+                    'publish_date': publish_date,
+                }
+            )
+        except Exception as e:
+            logger.error(f"Couldn't post {post['url']}: {e}")
+            schedule.invalidate()
+            return False
+        return True
+
+    published = await asyncio.gather(*(
+        publish(post, attachment, publish_date, rerun_day)
+        for (post, attachment), (publish_date, rerun_day) in zip(attachments, plan)
+    ))
+    post_failed += published.count(False)
 
     ending = ''
     if to_post_count >= 2 and to_post_count <= 4:
@@ -341,18 +519,19 @@ async def post_handler(event: MessageEvent):
         ('search_id', int)
     ])
 )
-async def cancel_search_handler(event: MessageEvent):
-    if event.user_id not in ADMIN_IDS:
-        return
-
+@dedup_callback
+async def cancel_search_handler(event: MessageEvent, pipeline: Pipeline):
     payload = event.get_payload_json()
     search_id = payload['search_id']
 
     # Defaulting every post's status from search
-    to_post = await get_modified_from_search(search_id)
-    to_post_ids = [post['id'] for post in to_post]
-    await update_posts_status(to_post_ids, 'no_rating')
+    session = await get_pipeline_session(search_id, pipeline)
+    if session is None:
+        return
+    for post in session.get_modified():
+        session.set_status(post['id'], 'no_rating')
 
+    await close_search_session(search_id)
     await delete_search(search_id)
 
     await event.edit_message(
@@ -363,36 +542,42 @@ async def cancel_search_handler(event: MessageEvent):
 
 @bot.on.private_message(text=('.реран', '!реран'))
 async def rerun_info_handler(message: Message):
-    if message.from_id not in ADMIN_IDS:
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
         return
 
     try:
-        last_rerun_date = await get_last_rerun_day()
+        last_rerun_date = await get_last_rerun_day(pipeline)
     except FileNotFoundError:
         return (
-            '❌ Похоже, что последний день рерана Ху Тао ещё не установлен. Напишите'
-            ' ".установить реран"'
+            f'❌ Похоже, что последний день рерана {pipeline.character_name} ещё не установлен.'
+            ' Напишите ".установить реран"'
         )
     today_date = datetime.date.today()
     no_rerun_days = (today_date - last_rerun_date).days
     msg = (
-        f'🕒 Последний реран Ху Тао: {str(last_rerun_date)}\n'
-        f'⏳ Это уже {no_rerun_days} день без рерана Ху Тао.'
+        f'🕒 Последний реран {pipeline.character_name}: {str(last_rerun_date)}\n'
+        f'⏳ Это уже {no_rerun_days} день без рерана {pipeline.character_name}.'
     )
     return msg
 
 
 @bot.on.private_message(text=('.установить реран', '!установить реран'))
 async def set_rerun_day_info_handler(message: Message):
-    if message.from_id not in ADMIN_IDS:
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
         return
 
-    return 'Чтобы установить последний день рерана Ху Тао, укажите дату в формате "ГГГГ-ММ-ДД"'
+    return (
+        f'Чтобы установить последний день рерана {pipeline.character_name}, укажите дату'
+        ' в формате "ГГГГ-ММ-ДД"'
+    )
 
 
 @bot.on.private_message(text=('.установить реран <date_str>', '!установить реран <date_str>'))
 async def set_rerun_day_handler(message: Message, date_str: str):
-    if message.from_id not in ADMIN_IDS:
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
         return
 
     try:
@@ -403,10 +588,57 @@ async def set_rerun_day_handler(message: Message, date_str: str):
             ' как установить дату.'
         )
 
-    await set_last_rerun_day(last_rerun_date)
+    await set_last_rerun_day(pipeline, last_rerun_date)
     return '✅ Готово!'
 
 
+@bot.on.private_message(text=('.profile <seconds:int>', '.профиль <seconds:int>'))
+async def profile_handler(message: Message, seconds: int):
+    pipeline = get_admin_pipeline(message.group_id, message.from_id)
+    if pipeline is None:
+        return
+
+    busy_msg = '❌ Профилирование уже идёт, дождитесь его окончания.'
+    if is_profiling():
+        return busy_msg
+
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    await message.answer(f'🔬 Профилируем бота {seconds} секунд...')
+    try:
+        report = await profile(seconds)
+    except RuntimeError:
+        # Another profiling could have started while the message was being sent
+        return busy_msg
+
+    # VK doesn't allow messages longer than 4096 characters
+    if len(report) <= 4096:
+        return report
+    attachment = await doc_msg_upls[pipeline.name].upload(
+        report.encode(), peer_id=message.peer_id, title='profile.txt'
+    )
+    await message.answer('📄 Отчёт получился длинным, поэтому он в файле', attachment=attachment)
+
+
 if __name__ == '__main__':
-    bot.loop_wrapper.on_startup.append(create_db())
-    bot.run_forever()
+    startup_timer = StartupTimer(_started)
+    if CASSETTE_RECORD_PATH:
+        from cassette import record_cassette
+        record_cassette(
+            CASSETTE_RECORD_PATH,
+            bot,
+            [*pipeline_apis.values(), user.api],
+            dan,
+            {'wall': photo_wall_upl, **photo_msg_upls},
+        )
+    bot.loop_wrapper.on_startup.append(
+        start(startup_timer, list(pipeline_apis.values()), user.api, dan)
+    )
+    if CALLBACK_SERVER_PORT:
+        # aiohttp's server is only imported in Callback API mode
+        from callback_server import run_callback_server
+        run_callback_server(
+            bot,
+            {pipeline.group_id: pipeline_apis[pipeline.name] for pipeline in PIPELINES},
+        )
+    else:
+        run_multibot(bot, apis=pipeline_apis.values())
@@ -0,0 +1,104 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import functools
+
+from config import DANBOORU_TAG_LIMIT, PostFilter
+
+# These metatags don't count towards Danbooru's tag limit
+FREE_METATAGS = ('rating', 'status', 'limit')
+
+
+def _counts_towards_limit(term: str) -> bool:
+    metatag, _, value = term.lstrip('-~').partition(':')
+    return not (value and metatag.lower() in FREE_METATAGS)
+
+
+def _file_size_term(min_size: int | None, max_size: int | None) -> str:
+    return f'filesize:{min_size or ""}..{max_size or ""}'
+
+
+class CompiledFilter:
+    """
+    Danbooru query with as much of the filter in it as the tag limit allows,
+    plus a local check for everything that didn't fit.
+    """
+    def __init__(self, query: str, post_filter: PostFilter, tag_limit: int = DANBOORU_TAG_LIMIT):
+        terms = query.split()
+        used = sum(_counts_towards_limit(term) for term in terms)
+
+        def push_down(term: str) -> bool:
+            nonlocal used
+            if used >= tag_limit:
+                return False
+            terms.append(term)
+            used += 1
+            return True
+
+        # Required tags narrow the results down the most, so they go first
+        self.required_tags = frozenset(
+            tag for tag in post_filter.required_tags if not push_down(tag)
+        )
+
+        self.min_score = post_filter.min_score
+        if self.min_score is not None and push_down(f'score:>={self.min_score}'):
+            self.min_score = None
+
+        self.min_file_size = post_filter.min_file_size
+        self.max_file_size = post_filter.max_file_size
+        if (self.min_file_size, self.max_file_size) != (None, None) and push_down(
+            _file_size_term(self.min_file_size, self.max_file_size)
+        ):
+            self.min_file_size = self.max_file_size = None
+
+        self.blocked_tags = frozenset(
+            tag for tag in post_filter.blocked_tags if not push_down(f'-{tag}')
+        )
+
+        self.query = ' '.join(terms)
+        self.is_local = bool(
+            self.required_tags or self.blocked_tags
+            or (self.min_score, self.min_file_size, self.max_file_size) != (None, None, None)
+        )
+
+    def matches(self, post: dict) -> bool:
+        if not self.is_local:
+            return True
+
+        if self.required_tags or self.blocked_tags:
+            tags = post.get('tag_string', [])
+            # booru splits tag_string of the posts it returns, raw Danbooru posts have a string
+            if isinstance(tags, str):
+                tags = tags.split()
+            tags = set(tags)
+            if not self.required_tags <= tags or not self.blocked_tags.isdisjoint(tags):
+                return False
+
+        if self.min_score is not None and post.get('score', 0) < self.min_score:
+            return False
+        file_size = post.get('file_size', 0)
+        if self.min_file_size is not None and file_size < self.min_file_size:
+            return False
+        if self.max_file_size is not None and file_size > self.max_file_size:
+            return False
+        return True
+
+
+@functools.lru_cache(maxsize=32)
+def compile_filter(query: str, post_filter: PostFilter) -> CompiledFilter:
+    # Queries and filters come from the config, so they're compiled only once
+    return CompiledFilter(query, post_filter)
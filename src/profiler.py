@@ -0,0 +1,197 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from types import FrameType
+
+from loguru import logger
+
+from config import (
+    PROFILE_BLOCK_THRESHOLD,
+    PROFILE_SAMPLE_INTERVAL,
+    PROFILE_STACK_DEPTH,
+    PROFILE_TOP
+)
+
+Stack = tuple[str, ...]
+
+
+def _compare_snapshots(
+    first: tracemalloc.Snapshot, last: tracemalloc.Snapshot
+) -> list[tracemalloc.StatisticDiff]:
+    # Allocations of tracemalloc and of the profiler itself would be at the top otherwise
+    snapshot_filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ]
+    return last.filter_traces(snapshot_filters).compare_to(
+        first.filter_traces(snapshot_filters), 'lineno'
+    )
+
+
+def _format_frame(frame: FrameType) -> str:
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}'
+
+
+def _is_loop_internals(frame: FrameType) -> bool:
+    # Every callback is run from Handle._run, frames below it are the same for all of them
+    return frame.f_code.co_name == '_run' and frame.f_code.co_filename.endswith('events.py')
+
+
+def _is_idle(frame: FrameType) -> bool:
+    # Event loop waits for events in selector's select() when it has nothing to do
+    return frame.f_code.co_name == 'select' and frame.f_code.co_filename.endswith('selectors.py')
+
+
+class Profiler:
+    """
+    Profiles the running bot for a while: a thread samples stacks of the event loop,
+    a heartbeat coroutine catches the loop being blocked and tracemalloc compares
+    memory at the start and at the end.
+    """
+    def __init__(self):
+        self.running = False
+        self.samples = 0
+        self.idle_samples = 0
+        self.stacks: Counter[Stack] = Counter()
+        # Duration of each time the loop was blocked and the stack it was blocked at
+        self.blocks: list[tuple[float, Stack]] = []
+        self.allocations: list[tracemalloc.StatisticDiff] = []
+        self._loop_thread_id: int | None = None
+        self._heartbeat = 0.0
+        self._blocked_stack: Stack | None = None
+
+    def _get_stack(self) -> tuple[Stack, bool] | None:
+        # Innermost frames of the loop thread and whether the loop is idle
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None
+        idle = _is_idle(frame)
+        stack = []
+        while (
+            frame is not None
+            and not _is_loop_internals(frame)
+            and len(stack) < PROFILE_STACK_DEPTH
+        ):
+            stack.append(_format_frame(frame))
+            frame = frame.f_back
+        return tuple(stack), idle
+
+    def _sample(self) -> None:
+        # Runs in its own thread, so it sees the loop even when the loop is blocked
+        while self.running:
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+            result = self._get_stack()
+            if result is None:
+                continue
+            stack, idle = result
+            self.samples += 1
+            if idle:
+                self.idle_samples += 1
+                continue
+            self.stacks[stack] += 1
+
+            blocked_for = time.monotonic() - self._heartbeat - PROFILE_SAMPLE_INTERVAL
+            if blocked_for > PROFILE_BLOCK_THRESHOLD and self._blocked_stack is None:
+                # Stack is taken while the loop is still blocked, that's where it's stuck
+                self._blocked_stack = stack
+
+    async def _watch_loop(self) -> None:
+        while self.running:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(PROFILE_SAMPLE_INTERVAL)
+            late = time.monotonic() - self._heartbeat - PROFILE_SAMPLE_INTERVAL
+            if late > PROFILE_BLOCK_THRESHOLD:
+                self.blocks.append((late, self._blocked_stack or ('(stack was not caught)',)))
+            self._blocked_stack = None
+
+    async def run(self, seconds: float) -> None:
+        self.running = True
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+
+        # Memory is only traced while profiling, tracing slows everything down
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        # Snapshots take a while when there's a lot of memory, they're taken off the loop
+        first_snapshot = await asyncio.to_thread(tracemalloc.take_snapshot)
+        sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        sampler.start()
+        watcher = asyncio.create_task(self._watch_loop())
+        logger.info(f'Profiling for {seconds} seconds')
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.running = False
+            await watcher
+            await asyncio.to_thread(sampler.join)
+            last_snapshot = await asyncio.to_thread(tracemalloc.take_snapshot)
+            if started_tracing:
+                tracemalloc.stop()
+
+        self.allocations = await asyncio.to_thread(
+            _compare_snapshots, first_snapshot, last_snapshot
+        )
+
+    def report(self, seconds: float) -> str:
+        busy_samples = self.samples - self.idle_samples
+        lines = [
+            f'Profiled for {seconds} seconds, {self.samples} samples,'
+            f' loop was busy in {busy_samples / (self.samples or 1):.0%} of them',
+            '',
+            f'Busiest stacks (innermost frame first), out of {busy_samples} busy samples:',
+        ]
+        for stack, count in self.stacks.most_common(PROFILE_TOP):
+            lines.append(f'{count} ({count / (busy_samples or 1):.0%}):')
+            lines.extend(f'    {frame}' for frame in stack)
+
+        lines += [
+            '',
+            f'Loop was blocked for more than {PROFILE_BLOCK_THRESHOLD}s {len(self.blocks)} times:',
+        ]
+        for blocked_for, stack in sorted(self.blocks, reverse=True)[:PROFILE_TOP]:
+            lines.append(f'{blocked_for * 1000:.0f}ms:')
+            lines.extend(f'    {frame}' for frame in stack)
+
+        lines += ['', 'Biggest memory growth:']
+        lines.extend(str(stat) for stat in self.allocations[:PROFILE_TOP])
+        return '\n'.join(lines)
+
+
+_lock = asyncio.Lock()
+
+
+def is_profiling() -> bool:
+    return _lock.locked()
+
+
+async def profile(seconds: float) -> str:
+    # Returns the report, only one profiling can run at a time
+    if _lock.locked():
+        raise RuntimeError('Profiling is already running')
+    async with _lock:
+        profiler = Profiler()
+        await profiler.run(seconds)
+        return profiler.report(seconds)
@@ -0,0 +1,119 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import time
+
+from loguru import logger
+from vkbottle import API
+
+from config import PUBLISH_SCHEDULE_TTL, Pipeline
+from utils import get_last_posts, get_postponed_posts, get_rerun_day
+
+
+class PublishSchedule:
+    """
+    When the posts of one pipeline get published. Postponed queue is read from VK once
+    and then kept up to date locally, so that batches don't collide with each other.
+    """
+    def __init__(self, pipeline: Pipeline):
+        self.pipeline = pipeline
+        # Publish dates of postponed posts, sorted
+        self.slots: list[int] = []
+        self.last_post_time = 0
+        self.last_rerun_day = 0
+        self.loaded_at: float | None = None
+
+    def is_stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > PUBLISH_SCHEDULE_TTL
+
+    def invalidate(self) -> None:
+        # Something went wrong while posting, so the queue is read again next time
+        self.loaded_at = None
+
+    async def load(self, api: API) -> None:
+        postponed_posts = sorted(
+            await get_postponed_posts(api, self.pipeline.group_id), key=lambda post: post['date']
+        )
+        self.slots = [post['date'] for post in postponed_posts]
+        rerun_day = get_rerun_day(postponed_posts[::-1], self.pipeline)
+
+        if rerun_day is None:
+            # Queue is empty or has no rerun days, the wall is only read in that case
+            posts = await get_last_posts(api, self.pipeline.group_id)
+            self.last_post_time = posts[0]['date']
+            rerun_day = get_rerun_day(posts, self.pipeline)
+        if rerun_day is None:
+            raise ValueError(f"Couldn't find rerun day of {self.pipeline.name} on the wall")
+
+        self.last_rerun_day = rerun_day
+        self.loaded_at = time.monotonic()
+        logger.info(
+            f'Loaded publish schedule of {self.pipeline.name}: {len(self.slots)} postponed posts,'
+            f' last rerun day is {rerun_day}'
+        )
+
+    def _move_published(self, now: int) -> None:
+        # Postponed posts that were published since the queue was read
+        published = bisect.bisect_right(self.slots, now)
+        if published:
+            self.last_post_time = max(self.last_post_time, self.slots[published-1])
+            del self.slots[:published]
+
+    def plan(self, count: int, now: int | None = None) -> list[tuple[int | None, int]]:
+        """
+        Returns publish date (None means right away) and rerun day for each of the next
+        `count` posts. New posts always go after the queue, so rerun days stay in order.
+        """
+        now = now or int(time.time())
+        self._move_published(now)
+        last_post_time = self.slots[-1] if self.slots else self.last_post_time
+        rerun_day = self.last_rerun_day
+
+        plan = []
+        for _ in range(count):
+            rerun_day += 1
+            if last_post_time + self.pipeline.post_interval < now:
+                # [POST_INTERVAL] seconds has passed since last post
+                plan.append((None, rerun_day))
+                last_post_time = now
+            else:
+                last_post_time += self.pipeline.post_interval
+                plan.append((last_post_time, rerun_day))
+        return plan
+
+    def reserve(self, count: int) -> list[tuple[int | None, int]]:
+        # Same as plan, but the slots are taken right away, so other batches can't get them
+        now = int(time.time())
+        plan = self.plan(count, now)
+        for publish_date, rerun_day in plan:
+            if publish_date is None:
+                self.last_post_time = now
+            else:
+                bisect.insort(self.slots, publish_date)
+            self.last_rerun_day = rerun_day
+        return plan
+
+
+_schedules: dict[str, PublishSchedule] = {}
+
+
+async def get_publish_schedule(api: API, pipeline: Pipeline) -> PublishSchedule:
+    schedule = _schedules.setdefault(pipeline.name, PublishSchedule(pipeline))
+    if schedule.is_stale():
+        await schedule.load(api)
+    return schedule
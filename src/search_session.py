@@ -0,0 +1,213 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from typing import Literal
+
+from loguru import logger
+from vkbottle import Callback, Keyboard
+from vkbottle import KeyboardButtonColor as Color
+
+from config import MAX_CACHED_SESSIONS, SESSION_FLUSH_BATCH_SIZE
+from db import (
+    get_posts_attachments,
+    get_posts_by_ids,
+    get_search,
+    set_posts_statuses
+)
+from enums import PostAction
+
+
+class SearchSession:
+    """
+    Everything needed to review a search, kept in memory for as long as the review lasts.
+    Rating changes are written to the db in batches, see `flush`.
+    """
+    def __init__(
+        self,
+        search_id: int,
+        pipeline: str,
+        posts: list[dict],
+        attachments: dict[int, str] | None = None,
+    ):
+        self.search_id = search_id
+        self.pipeline = pipeline
+        self.post_ids = [post['id'] for post in posts]
+        self.posts = {post['id']: post for post in posts}
+        self.attachments = attachments or {}
+        self.pending_statuses: dict[int, str] = {}
+        # Offset of the post that's shown right now, None when no post is shown
+        self.current_offset: int | None = None
+        self._keyboards: dict[int, str] = {}
+
+    def get_post(self, offset: int) -> dict | None:
+        if offset >= len(self.post_ids):
+            return None
+        return self.posts[self.post_ids[offset]]
+
+    def extend(self, posts: list[dict]) -> None:
+        # Posts found after the review has started go to the end
+        last_offset = len(self.post_ids)
+        for post in posts:
+            if post['id'] not in self.posts:
+                self.post_ids.append(post['id'])
+                self.posts[post['id']] = post
+        # Keyboard of the old last offset was the "end search" one
+        self._keyboards.pop(last_offset, None)
+
+    def set_status(
+        self, post_id: int, status: Literal['no_rating', 'to_post', 'deleted']
+    ) -> None:
+        self.posts[post_id]['status'] = status
+        self.pending_statuses[post_id] = status
+
+    def should_flush(self) -> bool:
+        return len(self.pending_statuses) >= SESSION_FLUSH_BATCH_SIZE
+
+    async def flush(self) -> None:
+        if not self.pending_statuses:
+            return
+
+        # Statuses stay pending until they're written, so get_pending_statuses still sees them
+        statuses = dict(self.pending_statuses)
+        logger.info(f'Saving {len(statuses)} rating changes from search {self.search_id}')
+        await set_posts_statuses(self.pipeline, statuses)
+        for post_id, status in statuses.items():
+            # Changes made during the write are written next time
+            if self.pending_statuses.get(post_id) == status:
+                del self.pending_statuses[post_id]
+
+    def get_modified(
+        self, include_only: Literal['no_rating', 'to_post', 'deleted'] | None = None
+    ) -> list[dict]:
+        # Posts are returned in search order
+        posts = [self.posts[post_id] for post_id in self.post_ids]
+        if include_only:
+            return [post for post in posts if post['status'] == include_only]
+        return [post for post in posts if post['status'] != 'no_rating']
+
+    def get_keyboard(self, offset: int) -> str:
+        keyboard = self._keyboards.get(offset)
+        if keyboard is None:
+            keyboard = self._build_keyboard(offset)
+            self._keyboards[offset] = keyboard
+        return keyboard
+
+    def _build_keyboard(self, offset: int) -> str:
+        show_post = self.get_post(offset)
+        end_payload = {'cmd': PostAction.END_SEARCH.value, 'search_id': self.search_id}
+        if show_post is None:
+            return (
+                Keyboard(inline=True)
+                .add(Callback('✅ Закончить поиск', payload=end_payload))
+            ).get_json()
+
+        def rate_payload(action: PostAction) -> dict:
+            return {
+                'cmd': action.value,
+                'post_id': show_post['id'],
+                'search_id': self.search_id,
+                'new_offset': offset+1,
+            }
+
+        return (
+            Keyboard(inline=True)
+            .add(
+                Callback('✅ Запостить/В отложку', payload=rate_payload(PostAction.GOOD_POST)),
+                color=Color.POSITIVE,
+            )
+            .add(
+                Callback('❌ Удалить', payload=rate_payload(PostAction.DELETE_POST)),
+                color=Color.NEGATIVE,
+            )
+            .row()
+            .add(
+                Callback('❓ Я хз', payload=rate_payload(PostAction.UNSURE_POST)),
+                color=Color.PRIMARY,
+            )
+            .row()
+            .add(
+                Callback('⏭ Закончить поиск', payload=end_payload),
+                color=Color.SECONDARY,
+            )
+        ).get_json()
+
+
+# Sessions are moved to the end when they're used, so the first one is the least recently used
+_sessions: OrderedDict[int, SearchSession] = OrderedDict()
+
+
+async def _evict_sessions() -> None:
+    while len(_sessions) > MAX_CACHED_SESSIONS:
+        search_id, session = next(iter(_sessions.items()))
+        # Removed after flushing, so its ratings are seen as pending until they're written
+        await session.flush()
+        # Session could've been used during the flush, then it's kept
+        if next(iter(_sessions), None) == search_id and not session.pending_statuses:
+            _sessions.pop(search_id)
+
+
+async def register_search_session(
+    search_id: int,
+    pipeline: str,
+    posts: list[dict],
+    attachments: dict[int, str] | None = None,
+) -> SearchSession:
+    # Used when a search was just created and all of its posts are already known
+    session = SearchSession(search_id, pipeline, posts, attachments)
+    _sessions[search_id] = session
+    await _evict_sessions()
+    return session
+
+
+async def get_search_session(search_id: int) -> SearchSession:
+    session = _sessions.get(search_id)
+    if session:
+        _sessions.move_to_end(search_id)
+        return session
+
+    # Bot was probably restarted in the middle of a review, restoring from the db
+    logger.info(f'Loading search {search_id} from db')
+    pipeline, post_ids = await get_search(search_id)
+    posts = {post['id']: post for post in await get_posts_by_ids(pipeline, post_ids)}
+    attachments = await get_posts_attachments(pipeline, post_ids)
+
+    # Another callback could've loaded the same search while we were waiting for the db
+    session = _sessions.get(search_id)
+    if session:
+        _sessions.move_to_end(search_id)
+        return session
+    return await register_search_session(
+        search_id, pipeline, [posts[post_id] for post_id in post_ids], attachments
+    )
+
+
+def get_pending_statuses(pipeline: str) -> dict[int, str]:
+    # Ratings from live sessions of the pipeline that aren't in the db yet
+    return {
+        post_id: status
+        for session in list(_sessions.values()) if session.pipeline == pipeline
+        for post_id, status in session.pending_statuses.items()
+    }
+
+
+async def close_search_session(search_id: int) -> None:
+    session = _sessions.get(search_id)
+    if session:
+        session.current_offset = None
+        await session.flush()
+        _sessions.pop(search_id, None)
@@ -0,0 +1,70 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from loguru import logger
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Makes concurrent calls with the same key share one run of the function.
+    If `ttl` is set, the result is also reused for `ttl` seconds after the run is over,
+    which catches double taps that arrive right after the first one was handled.
+    Failed runs are never reused.
+    """
+    def __init__(self, ttl: float = 0):
+        self.ttl = ttl
+        self._flights: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        flight = self._flights.get(key)
+        if flight is not None:
+            logger.info(f'Reusing in-flight result for {key}')
+            return await asyncio.shield(flight)
+
+        loop = asyncio.get_running_loop()
+        flight = loop.create_future()
+        # Nobody might be waiting for this flight, so its exception is marked as retrieved
+        flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._flights[key] = flight
+
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            flight.cancel()
+            self._forget(key, flight)
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            self._forget(key, flight)
+            raise
+
+        flight.set_result(result)
+        if self.ttl:
+            loop.call_later(self.ttl, self._forget, key, flight)
+        else:
+            self._forget(key, flight)
+        return result
+
+    def _forget(self, key: Hashable, flight: asyncio.Future) -> None:
+        # The key could've been taken by a newer flight already
+        if self._flights.get(key) is flight:
+            del self._flights[key]
@@ -0,0 +1,91 @@
+# Hu Tao Art Searcher
+# Copyright (C) 2024  F1zzTao
+
+# This file is part of Hu Tao Art Searcher.
+# Hu Tao Art Searcher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Hu Tao Art Searcher.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+from typing import Awaitable
+
+from loguru import logger
+from vkbottle import API
+
+from config import PIPELINES, WARM_UP_TIMEOUT
+from db import create_db
+from image_searchers import DanbooruSearcher
+from utils import warm_attachment_cache
+
+
+class StartupTimer:
+    """
+    Times startup phases and reports them once the bot is ready.
+    Everything is measured as wall-clock time since `started`, taken before the imports.
+    """
+    def __init__(self, started: float):
+        self.started = started
+        self.phases: dict[str, float] = {'imports': time.perf_counter() - started}
+
+    async def measure(self, name: str, step: Awaitable, required: bool = False) -> None:
+        started = time.perf_counter()
+        try:
+            if required:
+                await step
+            else:
+                await asyncio.wait_for(step, WARM_UP_TIMEOUT)
+        except Exception as e:
+            if required:
+                raise
+            # Bot still works without warm-up, the first response is just slower
+            logger.warning(f'Startup step "{name}" failed: {e!r}')
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def report(self) -> None:
+        phases = ', '.join(
+            f'{name} {seconds * 1000:.0f}ms' for name, seconds in self.phases.items()
+        )
+        ready = time.perf_counter() - self.started
+        logger.info(f'Ready in {ready * 1000:.0f}ms: {phases}')
+
+
+async def _warm_up_vk(group_apis: list[API], user_api: API) -> None:
+    # Opens connections to VK and checks the tokens
+    await asyncio.gather(
+        *(api.request('groups.getById', {}) for api in group_apis),
+        user_api.request('users.get', {}),
+    )
+
+
+async def _warm_up_danbooru(searcher: DanbooruSearcher) -> None:
+    # Importing booru takes a moment, it's done in a thread so that other steps can go on
+    await asyncio.to_thread(lambda: searcher.dan)
+
+
+async def _warm_up_attachments() -> None:
+    # Loads attachments of recent posts into the cache that searches use
+    await asyncio.gather(*(warm_attachment_cache(pipeline.name) for pipeline in PIPELINES))
+
+
+async def start(
+    timer: StartupTimer, group_apis: list[API], user_api: API, searcher: DanbooruSearcher
+) -> None:
+    # Db has to be created before anything reads it, everything else is warmed up at once
+    await timer.measure('db', create_db(), required=True)
+    await asyncio.gather(
+        timer.measure('vk', _warm_up_vk(group_apis, user_api)),
+        timer.measure('danbooru', _warm_up_danbooru(searcher)),
+        timer.measure('attachments', _warm_up_attachments()),
+    )
+    timer.report()
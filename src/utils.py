@@ -17,49 +17,148 @@
 
 import asyncio
 import datetime
+import json
 import re
-from typing import Literal
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Coroutine, Literal
 
 import aiofiles
-import aiohttp
 from loguru import logger
-from vkbottle import API, Callback, Keyboard
-from vkbottle import KeyboardButtonColor as Color
-from vkbottle import PhotoWallUploader
+from vkbottle import API, Callback, Keyboard, PhotoWallUploader
+from vkbottle.http import SingleAiohttpClient
 from vkbottle.tools import PhotoMessageUploader
 from vkbottle_types.objects import WallWallpostFull
 
 from config import (
+    ATTACHMENT_CACHE_SIZE,
     CHARACTER_RENAMINGS,
-    HU_TAO_RUSSIAN_TAG,
-    IGNORE_TAGS,
-    LAST_RERUN_DATE_PATH,
-    RERUN_DAY_SEARCH_RE
+    DANBOORU_IDS_PER_REQUEST,
+    DANBOORU_MAX_SEARCH_PAGES,
+    DANBOORU_PAGE_SIZE,
+    HISTORY_PAGE_SIZE,
+    IMAGE_CACHE_MAX_BYTES,
+    PHOTO_LATENCY_BUDGET,
+    SEARCH_BATCH_SIZE,
+    Pipeline
 )
 from db import (
-    get_post,
     get_post_attachment,
-    get_posts,
-    get_search_posts,
-    save_uploaded_attachment
+    get_posts_page,
+    get_recent_attachments,
+    get_reviewed_post_ids,
+    save_uploaded_attachment,
+    update_posts_metadata
 )
-from enums import PostAction
+from enums import HistoryAction
+from image_searchers import DanbooruSearcher
+from post_filter import compile_filter
+from search_session import SearchSession, get_pending_statuses, get_search_session
+from single_flight import SingleFlight
+
+_upload_flights = SingleFlight()
+_background_tasks: set[asyncio.Task] = set()
+_image_cache: OrderedDict[str, bytes] = OrderedDict()
+_image_cache_bytes = 0
+_attachment_cache: OrderedDict[tuple[str, int], str] = OrderedDict()
+
+HISTORY_STATUSES = {
+    'новые': 'no_rating',
+    'одобренные': 'to_post',
+    'удалённые': 'deleted',
+    'удаленные': 'deleted',
+    'no_rating': 'no_rating',
+    'to_post': 'to_post',
+    'deleted': 'deleted',
+}
+STATUS_EMOJIS = {'no_rating': '❔', 'to_post': '✅', 'deleted': '❌'}
+PHOTO_LOADING_NOTE = '\n🖼 Картинка загружается...'
+PHOTO_FAILED_NOTE = '\n⚠️ Не удалось загрузить картинку'
+HISTORY_FILTERS_TOO_LONG_NOTE = (
+    '\n\n⚠️ Фильтры слишком длинные, чтобы листать дальше. Сократите их, чтобы увидеть больше'
+)
+# VK doesn't accept button payloads longer than this
+MAX_PAYLOAD_LENGTH = 255
+
+
+def run_in_background(coro: Coroutine) -> None:
+    # Tasks are kept here until they're done, otherwise they could be garbage collected
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_background_error)
+
 
+def _log_background_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.opt(exception=task.exception()).error('Background task failed')
+
+
+async def img_url_to_bytes(url: str, cache: bool = True) -> bytes:
+    """
+    Convert an image URL to a byte array.
+    Raises aiohttp.ClientResponseError if the image couldn't be downloaded.
+    """
+    image_bytes = _image_cache.get(url)
+    if image_bytes is not None:
+        _image_cache.move_to_end(url)
+        return image_bytes
 
-async def img_url_to_bytes(url: str) -> bytes:
-    # Convert an image URL to a byte array
     logger.info(f'Reading image from this URL: {url}')
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            return await response.read()
+    # This client is shared with vkbottle, so are its connections
+    # Without raise_for_status an error page would be uploaded (and cached) instead of the image
+    image_bytes = await SingleAiohttpClient().request_content(url, raise_for_status=True)
+    if cache:
+        _cache_image(url, image_bytes)
+    return image_bytes
+
+
+def _cache_image(url: str, image_bytes: bytes) -> None:
+    global _image_cache_bytes
+    if len(image_bytes) > IMAGE_CACHE_MAX_BYTES:
+        return
+    _image_cache[url] = image_bytes
+    _image_cache_bytes += len(image_bytes)
+    while _image_cache_bytes > IMAGE_CACHE_MAX_BYTES:
+        _, old_image_bytes = _image_cache.popitem(last=False)
+        _image_cache_bytes -= len(old_image_bytes)
 
 
 async def get_attachment(
-    uploader: PhotoMessageUploader, peer_id: int, url: str, post_id: int
+    uploader: PhotoMessageUploader, pipeline: str, peer_id: int, url: str, post_id: int
+) -> str:
+    # Concurrent requests for the same post share one upload
+    return await _upload_flights.do(
+        (pipeline, post_id), lambda: _get_attachment(uploader, pipeline, peer_id, url, post_id)
+    )
+
+
+def _remember_attachment(pipeline: str, post_id: int, attachment: str) -> None:
+    _attachment_cache[(pipeline, post_id)] = attachment
+    _attachment_cache.move_to_end((pipeline, post_id))
+    if len(_attachment_cache) > ATTACHMENT_CACHE_SIZE:
+        _attachment_cache.popitem(last=False)
+
+
+async def warm_attachment_cache(pipeline: str) -> int:
+    # Called on startup, so the first search doesn't have to go to the db for attachments
+    attachments = await get_recent_attachments(pipeline, ATTACHMENT_CACHE_SIZE)
+    for post_id, attachment in attachments.items():
+        _remember_attachment(pipeline, post_id, attachment)
+    return len(attachments)
+
+
+async def _get_attachment(
+    uploader: PhotoMessageUploader, pipeline: str, peer_id: int, url: str, post_id: int
 ) -> str:
-    post_attachment = await get_post_attachment(post_id)
+    post_attachment = _attachment_cache.get((pipeline, post_id))
+    if post_attachment:
+        logger.info(f'Attachment for post {post_id} is cached')
+        return post_attachment
+
+    post_attachment = await get_post_attachment(pipeline, post_id)
     if post_attachment:
         logger.info(f'Attachment for post {post_id} already exists in db')
+        _remember_attachment(pipeline, post_id, post_attachment)
         return post_attachment
 
     # Uploading image as an attachment and saving it in the database
@@ -69,7 +168,8 @@ async def get_attachment(
         file_source=image_bytes,
         peer_id=peer_id
     )
-    await save_uploaded_attachment(post_id, photo)
+    await save_uploaded_attachment(pipeline, post_id, photo)
+    _remember_attachment(pipeline, post_id, photo)
     return photo
 
 
@@ -78,8 +178,9 @@ async def upload_wall_photo(
 ) -> str | None:
     # Uploading image as a wall photo
     logger.info(f"Uploading new wall photo from this url: {url}")
-    image_bytes = await img_url_to_bytes(url)
     try:
+        # Originals can be huge and they're only uploaded once, so they aren't cached
+        image_bytes = await img_url_to_bytes(url, cache=False)
         photo = await uploader.upload(image_bytes)
     except Exception as e:
         logger.error(f"Couldn't upload photo for wall: {e}")
@@ -87,36 +188,39 @@ async def upload_wall_photo(
     return photo
 
 
-async def run_search(
-    uploader: PhotoMessageUploader, peer_id: int, search_id: int, offset: int = 0
-) -> dict:
-    try:
-        show_post_id = (await get_search_posts(search_id))[offset]
-    except IndexError:
-        end_kbd = (
-            Keyboard(inline=True)
-            .add(
-                Callback(
-                    '✅ Закончить поиск',
-                    payload={'cmd': PostAction.END_SEARCH.value, 'search_id': search_id}
-                )
-            )
-        ).get_json()
-        return {
-            "message": "🚩 Вы просмотрели все арты!",
-            "photo": None,
-            "keyboard": end_kbd,
-        }
-
-    show_post = await get_post(show_post_id)
-
+async def _upload_session_photo(
+    uploader: PhotoMessageUploader, peer_id: int, session: SearchSession, post: dict
+) -> str | None:
     try:
-        photo = await get_attachment(uploader, peer_id, show_post['preview_url'], show_post['id'])
+        photo = await get_attachment(
+            uploader, session.pipeline, peer_id, post['preview_url'], post['id']
+        )
     except Exception as e:
         # ? This is a very random error that I don't
         # ? even know why it happens or how to fix it...
         logger.info(f"Couldn't upload an image: {e}")
-        photo = None
+        return None
+    session.attachments[post['id']] = photo
+    return photo
+
+
+async def show_search(
+    uploader: PhotoMessageUploader,
+    peer_id: int,
+    session: SearchSession,
+    edit: Callable[[str, str | None, str | None], Awaitable],
+    offset: int = 0,
+) -> None:
+    """
+    Edits the message into the post at `offset` using `edit(message, photo, keyboard)`.
+    If the photo isn't ready within PHOTO_LATENCY_BUDGET seconds, the post is shown
+    without it first, and the photo is added with a second edit once it's uploaded.
+    """
+    session.current_offset = offset
+    show_post = session.get_post(offset)
+    if show_post is None:
+        await edit("🚩 Вы просмотрели все арты!", None, session.get_keyboard(offset))
+        return
 
     msg = (
         f'🎨 Арт от {show_post["artist"]}\n'
@@ -124,104 +228,60 @@ async def run_search(
         f'Источник: {show_post["source"]}\n'
         f'Персонажи: {show_post["characters"]}\n'
     )
-    rate_kbd = (
-        Keyboard(inline=True)
-        .add(
-            Callback(
-                '✅ Запостить/В отложку',
-                payload={
-                    'cmd': PostAction.GOOD_POST.value,
-                    'post_id': show_post['id'],
-                    'search_id': search_id,
-                    'new_offset': offset+1,
-                },
-            ),
-            color=Color.POSITIVE,
-        )
-        .add(
-            Callback(
-                '❌ Удалить',
-                payload={
-                    'cmd': PostAction.DELETE_POST.value,
-                    'post_id': show_post['id'],
-                    'search_id': search_id,
-                    'new_offset': offset+1,
-                },
-            ),
-            color=Color.NEGATIVE,
-        )
-        .row()
-        .add(
-            Callback(
-                '❓ Я хз',
-                payload={
-                    'cmd': PostAction.UNSURE_POST.value,
-                    'post_id': show_post['id'],
-                    'search_id': search_id,
-                    'new_offset': offset+1,
-                },
-            ),
-            color=Color.PRIMARY,
-        )
-        .row()
-        .add(
-            Callback(
-                '⏭ Закончить поиск',
-                payload={'cmd': PostAction.END_SEARCH.value, 'search_id': search_id}
-            ),
-            color=Color.SECONDARY,
-        )
-    ).get_json()
-    return {
-        "message": msg,
-        "photo": photo,
-        "keyboard": rate_kbd,
-    }
+    keyboard = session.get_keyboard(offset)
+    photo = session.attachments.get(show_post['id'])
+    if photo is not None:
+        await edit(msg, photo, keyboard)
+        return
+
+    upload = asyncio.ensure_future(_upload_session_photo(uploader, peer_id, session, show_post))
+    await asyncio.wait({upload}, timeout=PHOTO_LATENCY_BUDGET)
+    if upload.done():
+        photo = upload.result()
+        await edit(msg if photo else msg + PHOTO_FAILED_NOTE, photo, keyboard)
+        return
+
+    await edit(msg + PHOTO_LOADING_NOTE, None, keyboard)
+
+    async def add_late_photo():
+        photo = await upload
+        # Admin could've moved on to another post while the photo was uploading
+        if session.current_offset != offset:
+            return
+        await edit(msg if photo else msg + PHOTO_FAILED_NOTE, photo, keyboard)
+    run_in_background(add_late_photo())
 
 
 async def get_modified_from_search(
     search_id: int,
     include_only: Literal['no_rating', 'to_post', 'deleted'] | None = None,
-    sort: bool = False,
 ) -> list[dict]:
     # This gets all post info, not only ids. Might be useful in the future.
-    search_post_ids = await get_search_posts(search_id)
-    posts = await get_posts()
-
-    modified_posts = []
-    if include_only:
-        for post in posts:
-            if post['id'] in search_post_ids and post['status'] == include_only:
-                modified_posts.append(post)
-    else:
-        for post in posts:
-            if post['id'] in search_post_ids and post['status'] != 'no_rating':
-                modified_posts.append(post)
+    session = await get_search_session(search_id)
+    return session.get_modified(include_only)
 
-    if sort:
-        modified_posts = sorted(modified_posts, key=lambda x: search_post_ids.index(x['id']))
-    return modified_posts
 
-
-def hu_tao_sort(character: str):
-    if character == "HuTao":
+def main_character_sort(character: str, pipeline: Pipeline):
+    if character == pipeline.character_tag:
         return (0, character)
-    elif character == "ХуТао":
+    elif character == pipeline.russian_tag:
         return (1, character)
     else:
         return (2, character)
 
 
-def characters_to_tags(characters: str) -> str:
+def characters_to_tags(characters: str, pipeline: Pipeline) -> str:
     """
     Converts Genshin Impact character Danbooru-styled tags to normal tags.
-    This also sorts them, so Hu Tao is always first, just like she is at anything.
-    >>> characters_to_tags("keqing_(genshin_impact) hu_tao_(genshin_impact)")
+    This also sorts them, so pipeline's character is always first, just like Hu Tao is at anything.
+    >>> characters_to_tags("keqing_(genshin_impact) hu_tao_(genshin_impact)", hu_tao_pipeline)
     >>> "#HuTao #ХуТао #Keqing"
     """
     # Removing all the unnecessary tags
     characters_list = characters.split()
-    characters_list = [character for character in characters_list if character not in IGNORE_TAGS]
+    characters_list = [
+        character for character in characters_list if character not in pipeline.ignore_tags
+    ]
     characters = ' '.join(characters_list)
 
     # Making Danbooru-style tags look like normal tags
@@ -233,18 +293,238 @@ def characters_to_tags(characters: str) -> str:
         CHARACTER_RENAMINGS.get(character) or character for character in characters_list
     ]
     for i, character in enumerate(characters_list):
-        if character != 'HuTao':
+        if character != pipeline.character_tag or not pipeline.russian_tag:
             continue
 
         # Adding Russian variant right next to the original one
-        characters_list.insert(i+1, HU_TAO_RUSSIAN_TAG)
+        characters_list.insert(i+1, pipeline.russian_tag)
         break
 
-    characters_sorted_list = sorted(characters_list, key=hu_tao_sort)
+    characters_sorted_list = sorted(
+        characters_list, key=lambda character: main_character_sort(character, pipeline)
+    )
     characters = ' '.join('#'+word for word in characters_sorted_list)
     return characters
 
 
+def danbooru_post_to_row(
+    post: dict,
+    pipeline: Pipeline,
+    status: Literal['no_rating', 'to_post', 'deleted'] = 'no_rating',
+) -> dict:
+    # Raises KeyError if Danbooru didn't return some of the keys, banned posts have no urls
+    return {
+        'id': post['id'],
+        'preview_url': post['large_file_url'],
+        'file_url': post['file_url'],
+        'artist': post['tag_string_artist'],
+        'characters': characters_to_tags(post['tag_string_character'], pipeline),
+        'url': post['post_url'],
+        'source': post['source'],
+        'status': status,
+    }
+
+
+async def _get_reviewed_post_ids(pipeline: str) -> set[int]:
+    """
+    Ids of reviewed posts, including ratings that live sessions haven't written yet.
+    Pending ratings are taken before and after reading the db, so the ones
+    that were being written at that moment aren't missed.
+    """
+    pending_before = get_pending_statuses(pipeline)
+    reviewed_post_ids = await get_reviewed_post_ids(pipeline)
+    for post_id, status in {**pending_before, **get_pending_statuses(pipeline)}.items():
+        if status == 'no_rating':
+            reviewed_post_ids.discard(post_id)
+        else:
+            reviewed_post_ids.add(post_id)
+    return reviewed_post_ids
+
+
+async def iter_new_posts(
+    searcher: DanbooruSearcher, pipeline: Pipeline, query: str
+) -> AsyncIterator[list[dict]]:
+    """
+    Yields new posts page by page, as soon as each page is checked,
+    until SEARCH_BATCH_SIZE posts are found or the results run out.
+    """
+    post_filter = compile_filter(query, pipeline.post_filter)
+
+    def search_page(page: int):
+        return searcher.search(post_filter.query, limit=DANBOORU_PAGE_SIZE, page=page)
+
+    # Reviewed ids are read while Danbooru is searching
+    reviewed_posts_ids, new_posts = await asyncio.gather(
+        _get_reviewed_post_ids(pipeline.name), search_page(1)
+    )
+
+    found_count = 0
+    for page in range(1, DANBOORU_MAX_SEARCH_PAGES+1):
+        if page > 1:
+            new_posts = await search_page(page)
+
+        show_posts = []
+        for post in new_posts:
+            if post['id'] in reviewed_posts_ids or not post_filter.matches(post):
+                continue
+
+            try:
+                show_posts.append(danbooru_post_to_row(post, pipeline))
+            except KeyError:
+                # Some posts don't have some of the keys for some reason
+                continue
+            logger.info(f'Found new post (by {post["tag_string_artist"]}): {post["post_url"]}')
+            if found_count + len(show_posts) >= SEARCH_BATCH_SIZE:
+                break
+
+        found_count += len(show_posts)
+        if show_posts:
+            yield show_posts
+        if found_count >= SEARCH_BATCH_SIZE or len(new_posts) < DANBOORU_PAGE_SIZE:
+            # Either there's enough posts already or that was the last page
+            return
+
+
+async def refresh_posts(
+    searcher: DanbooruSearcher, pipeline: Pipeline, posts: list[dict]
+) -> tuple[list[dict], list[int]]:
+    """
+    Checks stored posts against Danbooru, looking up to DANBOORU_IDS_PER_REQUEST posts at once.
+    Returns posts that were changed there and ids of posts that are gone from there,
+    both are already saved to the db.
+    Posts of lookups that failed are left as they are, if all of them failed, the error is raised.
+    """
+    stored_posts = {post['id']: post for post in posts}
+    post_ids = list(stored_posts)
+    chunks = [
+        post_ids[i:i+DANBOORU_IDS_PER_REQUEST]
+        for i in range(0, len(post_ids), DANBOORU_IDS_PER_REQUEST)
+    ]
+    # status:any includes deleted posts, it doesn't count towards the tag limit
+    results = await asyncio.gather(
+        *(
+            searcher.search(f'id:{",".join(map(str, chunk))} status:any', limit=len(chunk))
+            for chunk in chunks
+        ),
+        return_exceptions=True
+    )
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors and len(errors) == len(results):
+        raise errors[0]
+    checked_post_ids = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Couldn't refresh {len(chunk)} posts: {result!r}")
+        else:
+            checked_post_ids += chunk
+
+    found_posts = {}
+    for danbooru_post in (
+        post for result in results if not isinstance(result, Exception) for post in result
+    ):
+        stored_post = stored_posts.get(danbooru_post.get('id'))
+        if stored_post is None or danbooru_post.get('is_deleted'):
+            continue
+        try:
+            found_posts[stored_post['id']] = danbooru_post_to_row(
+                danbooru_post, pipeline, stored_post['status']
+            )
+        except KeyError:
+            continue
+
+    changed_posts = [
+        post for post_id, post in found_posts.items() if post != stored_posts[post_id]
+    ]
+    gone_post_ids = [post_id for post_id in checked_post_ids if post_id not in found_posts]
+    if changed_posts or gone_post_ids:
+        logger.info(
+            f'Refreshed {len(checked_post_ids)} posts: {len(changed_posts)} changed,'
+            f' {len(gone_post_ids)} gone from Danbooru'
+        )
+        await update_posts_metadata(pipeline.name, changed_posts, gone_post_ids)
+    return changed_posts, gone_post_ids
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def parse_history_filters(filters: str) -> tuple[str | None, str | None]:
+    """
+    Turns arguments of the history command into a post status and an FTS5 query.
+    Raises ValueError if the status is unknown.
+    >>> parse_history_filters("статус:удалённые автор:wang_man персонаж:hu_tao keqing")
+    >>> ('deleted', '{artist}: "wang_man" AND {characters}: "hutao" AND "keqing"')
+    """
+    status = None
+    match_terms = []
+    for word in filters.split():
+        key, _, value = word.partition(':')
+        key = key.lower()
+        if not value:
+            match_terms.append(_fts_phrase(word))
+        elif key in ('статус', 'status'):
+            status = HISTORY_STATUSES.get(value.lower())
+            if status is None:
+                raise ValueError(value)
+        elif key in ('автор', 'artist'):
+            match_terms.append('{artist}: ' + _fts_phrase(value))
+        elif key in ('персонаж', 'character'):
+            # Characters are stored as hashtags, so they should look like them too
+            value = value.lstrip('#').replace('_(genshin_impact)', '').replace('_', '')
+            match_terms.append('{characters}: ' + _fts_phrase(value))
+        else:
+            match_terms.append(_fts_phrase(word))
+
+    return status, (' AND '.join(match_terms) or None)
+
+
+async def get_history_page(
+    pipeline: Pipeline, filters: str = '', before_id: int | None = None
+) -> dict:
+    try:
+        status, match = parse_history_filters(filters)
+    except ValueError as e:
+        return {
+            "message": (
+                f'❌ Неизвестный статус "{e}". Можно использовать: новые, одобренные, удалённые'
+            ),
+            "keyboard": None,
+        }
+
+    posts = await get_posts_page(pipeline.name, status, match, before_id, HISTORY_PAGE_SIZE)
+    if not posts:
+        return {
+            "message": '🤷 Больше ничего не нашлось' if before_id else '🤷 Ничего не нашлось',
+            "keyboard": None,
+        }
+
+    msg = '\n\n'.join(
+        f'{STATUS_EMOJIS[post["status"]]} {post["url"]} от {post["artist"]}\n{post["characters"]}'
+        for post in posts
+    )
+    keyboard = None
+    if len(posts) == HISTORY_PAGE_SIZE:
+        payload = {
+            'cmd': HistoryAction.NEXT_PAGE.value,
+            'before_id': posts[-1]['id'],
+            'filters': filters,
+        }
+        if len(json.dumps(payload, ensure_ascii=False)) <= MAX_PAYLOAD_LENGTH:
+            keyboard = (
+                Keyboard(inline=True)
+                .add(Callback('➡️ Дальше', payload=payload))
+            ).get_json()
+        else:
+            # Cutting the filters would make the next page run a different query
+            msg += HISTORY_FILTERS_TOO_LONG_NOTE
+    return {
+        "message": msg,
+        "keyboard": keyboard,
+    }
+
+
 async def get_last_posts(api: API, group_id: int, count=20) -> list[WallWallpostFull]:
     logger.info(f'Getting last {count} posts')
     # TODO: Replace once vkbottle fixes their shit
@@ -252,11 +532,19 @@ async def get_last_posts(api: API, group_id: int, count=20) -> list[WallWallpost
     return last_posts_request["response"]["items"]
 
 
-def get_rerun_day(posts: list[dict]) -> int | None:
+async def get_postponed_posts(api: API, group_id: int, count=100) -> list[WallWallpostFull]:
+    logger.info('Getting postponed posts')
+    postponed_posts_request = await api.request(
+        "wall.get", {"owner_id": -group_id, "count": count, "filter": "postponed"}
+    )
+    return postponed_posts_request["response"]["items"]
+
+
+def get_rerun_day(posts: list[dict], pipeline: Pipeline) -> int | None:
     for post in posts:
         try:
             post_text = post["text"]
-            re_match = re.search(RERUN_DAY_SEARCH_RE, post_text)
+            re_match = re.search(pipeline.rerun_day_search_re, post_text)
             day = int(re_match.group(1))
             return day
         except (KeyError, AttributeError):
@@ -264,22 +552,22 @@ def get_rerun_day(posts: list[dict]) -> int | None:
             continue
 
 
-def create_text(next_rerun_day: int, artist: str, characters: str):
+def create_text(pipeline: Pipeline, next_rerun_day: int, artist: str, characters: str):
     msg = (
-        f"{next_rerun_day} день без рерана Ху Тао\n\nАвтор: {artist}"
+        f"{next_rerun_day} день без рерана {pipeline.character_name}\n\nАвтор: {artist}"
         f"\n{characters} #genshinimpact #genshin_impact"
     )
     return msg
 
 
-async def get_last_rerun_day() -> datetime.date:
-    async with aiofiles.open(LAST_RERUN_DATE_PATH, 'r') as f:
+async def get_last_rerun_day(pipeline: Pipeline) -> datetime.date:
+    async with aiofiles.open(pipeline.last_rerun_date_path, 'r') as f:
         last_rerun_day = await f.read()
     return datetime.date.fromisoformat(last_rerun_day)
 
 
-async def set_last_rerun_day(last_rerun_day: datetime.date):
-    async with aiofiles.open(LAST_RERUN_DATE_PATH, 'w') as f:
+async def set_last_rerun_day(pipeline: Pipeline, last_rerun_day: datetime.date):
+    async with aiofiles.open(pipeline.last_rerun_date_path, 'w') as f:
         await f.write(str(last_rerun_day))
 
 